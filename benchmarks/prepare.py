@@ -0,0 +1,291 @@
+"""Benchmarks of the model preparation path using a synthetic PostGIS dataset
+
+Usage:
+    python -m benchmarks.prepare --dsn "dbname=test user=postgres password=password host=localhost" \\
+        --dem-tiles 4 --tile-size 250 --buildings 10000 --rain-cells 100 --timesteps 288 --runs 1000 \\
+        --output results.json --baseline previous.json
+"""
+from citycatpg import Run, fetch, fetch_many, add_many, server
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from rasterio.transform import Affine
+from datetime import datetime, timedelta
+from dataclasses import replace
+from typing import Callable, Optional
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+import uuid
+import warnings
+import numpy as np
+import pika
+import psycopg2
+import rasterio as rio
+
+x_min, y_max, srid = 400000, 600000, 27700
+
+
+def create_dataset(con: psycopg2.extensions.connection, prefix: str = 'benchmark', dem_tiles: int = 2,
+                   tile_size: int = 250, resolution: float = 5, buildings: int = 1000, rain_cells: int = 16,
+                   timesteps: int = 288, seed: int = 0) -> Run:
+    """Create a synthetic domain, DEM, rainfall grid, buildings and green areas
+
+    Args:
+        con: Postgres connection
+        prefix: Prefix of the names of the tables to create, existing tables are replaced
+        dem_tiles: Number of DEM tiles along each side of the domain
+        tile_size: Number of cells along each side of a DEM tile
+        resolution: Size of each DEM cell in metres
+        buildings: Number of buildings, half as many green areas are created
+        rain_cells: Number of rainfall grid cells, rounded down to a square number
+        timesteps: Number of rainfall values in each grid cell
+        seed: Seed of the random number generator
+
+    Returns:
+        Run: Configuration using the synthetic tables
+    """
+    random = np.random.RandomState(seed)
+    size = dem_tiles * tile_size * resolution
+    x_max, y_min = x_min + size, y_max - size
+    tables = {name: f'{prefix}_{name}' for name in ['domain', 'dem', 'rain', 'metadata', 'buildings', 'green_areas']}
+    start = datetime(2000, 1, 1)
+    frequency = timedelta(minutes=5)
+
+    with con:
+        with con.cursor() as cur:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS postgis_raster")
+            cur.execute("SET postgis.gdal_enabled_drivers TO 'GTiff'")
+            cur.execute(sql.SQL("""
+            DROP TABLE IF EXISTS {domain}, {dem}, {rain}, {metadata}, {buildings}, {green_areas};
+            CREATE TABLE {domain} (gid serial PRIMARY KEY, geom geometry);
+            CREATE TABLE {dem} (rid serial PRIMARY KEY, rast raster);
+            CREATE TABLE {rain} (gid serial PRIMARY KEY, geom geometry, series numeric[]);
+            CREATE TABLE {metadata} (dataset text PRIMARY KEY, source text, frequency interval, start timestamp);
+            CREATE TABLE {buildings} (gid serial PRIMARY KEY, geom geometry);
+            CREATE TABLE {green_areas} (gid serial PRIMARY KEY, geom geometry);
+            INSERT INTO {domain} (gid, geom) VALUES (1, ST_MakeEnvelope(%(x_min)s, %(y_min)s, %(x_max)s, %(y_max)s,
+                %(srid)s));
+            INSERT INTO {metadata} (dataset, frequency, start) VALUES (%(rain)s, %(frequency)s, %(start)s);
+            """).format(**{name: sql.Identifier(table) for name, table in tables.items()}),
+                dict(x_min=x_min, y_min=y_min, x_max=x_max, y_max=y_max, srid=srid, rain=tables['rain'],
+                     frequency=frequency, start=start))
+
+            tile_width = tile_size * resolution
+            for row in range(dem_tiles):
+                for col in range(dem_tiles):
+                    array = np.round(random.random((tile_size, tile_size)) * 10, 3)
+                    with rio.MemoryFile() as dem_file:
+                        with dem_file.open(driver='GTiff', height=tile_size, width=tile_size, count=1,
+                                           dtype=array.dtype, nodata=-9999, crs=f'EPSG:{srid}',
+                                           transform=Affine.translation(x_min + col * tile_width,
+                                                                        y_max - row * tile_width) *
+                                           Affine.scale(resolution, -resolution)) as dst:
+                            dst.write(array, 1)
+                        cur.execute(sql.SQL('INSERT INTO {dem} (rast) VALUES (ST_FromGDALRaster(%(rast)s))').format(
+                            dem=sql.Identifier(tables['dem'])), dict(rast=psycopg2.Binary(dem_file.read())))
+
+            cells = max(int(np.sqrt(rain_cells)), 1)
+            cell_width = size / cells
+            execute_values(cur, sql.SQL("""
+            INSERT INTO {rain} (geom, series) VALUES %s
+            """).format(rain=sql.Identifier(tables['rain'])).as_string(cur),
+                [(x_min + col * cell_width, y_min + row * cell_width, x_min + (col + 1) * cell_width,
+                  y_min + (row + 1) * cell_width, np.round(random.random(timesteps) * 5, 2).tolist())
+                 for row in range(cells) for col in range(cells)],
+                template=f'(ST_MakeEnvelope(%s, %s, %s, %s, {srid}), %s)', page_size=1000)
+
+            for table, count, width in [('buildings', buildings, 15), ('green_areas', buildings // 2, 30)]:
+                corners = random.random((count, 2)) * (size - width)
+                execute_values(cur, sql.SQL('INSERT INTO {table} (geom) VALUES %s').format(
+                    table=sql.Identifier(tables[table])).as_string(cur),
+                    [(x_min + x, y_min + y, x_min + x + width, y_min + y + width) for x, y in corners],
+                    template=f'(ST_MakeEnvelope(%s, %s, %s, %s, {srid}))', page_size=10000)
+
+            for table in tables.values():
+                cur.execute(sql.SQL('ANALYZE {table}').format(table=sql.Identifier(table)))
+
+    return Run(run_duration=3600, run_table=f'{prefix}_runs', domain_table=tables['domain'], domain_id=1,
+               dem_table=tables['dem'], rain_table=tables['rain'], rain_start=start,
+               rain_end=start + frequency * (timesteps - 1), metadata_table=tables['metadata'],
+               buildings_table=tables['buildings'], green_areas_table=tables['green_areas'])
+
+
+def copy_run(run: Run, **changes) -> Run:
+    """Copy a configuration with a new run_id
+
+    Args:
+        run: Configuration to copy
+        **changes: Fields to change
+
+    Returns:
+        Run: Copy of the configuration
+    """
+    return replace(run, run_id=str(uuid.uuid4()), model=None, **changes)
+
+
+def measure(function: Callable, repeat: int = 3) -> dict:
+    """Time a function
+
+    Args:
+        function: Function to call without arguments
+        repeat: Number of times to call the function
+
+    Returns:
+        dict: Duration of each call and the median duration in seconds
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return dict(seconds=seconds, median=statistics.median(seconds))
+
+
+def dispatch(con: psycopg2.extensions.connection, run: Run, runs: int, host: str, port: int, run_path: str):
+    """Publish runs to a queue and process them using run_server without executing CityCAT
+
+    The runs are added to the runs table as run_server fetches runs from there
+
+    Args:
+        con: Postgres connection
+        run: Configuration to copy
+        runs: Number of runs to publish
+        host: Hostname of AQMP server
+        port: Port of AQMP server
+        run_path: Directory in which to create the model directories
+    """
+    queue = f'{run.run_table}_queue'
+    run_ids = add_many(con, [copy_run(run, run_table='runs') for _ in range(runs)])
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=port))
+    connection.channel().queue_delete(queue=queue)
+    connection.close()
+    server.publish(run_ids, queue, host, port)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        server.run_server(con, run_path, run_path, queue=queue, host=host, port=port, close=True)
+
+
+def benchmark(dsn: str, dem_tiles: int = 2, tile_size: int = 250, resolution: float = 5, buildings: int = 1000,
+              rain_cells: int = 16, timesteps: int = 288, runs: int = 1000, repeat: int = 3,
+              amqp_host: Optional[str] = None, amqp_port: int = 5672, seed: int = 0) -> dict:
+    """Create a synthetic dataset and time each phase of preparing models
+
+    Args:
+        dsn: Postgres connection string
+        dem_tiles: Number of DEM tiles along each side of the domain
+        tile_size: Number of cells along each side of a DEM tile
+        resolution: Size of each DEM cell in metres
+        buildings: Number of buildings, half as many green areas are created
+        rain_cells: Number of rainfall grid cells, rounded down to a square number
+        timesteps: Number of rainfall values in each grid cell
+        runs: Number of runs to add and fetch
+        repeat: Number of times to repeat each measurement
+        amqp_host: Hostname of AQMP server used to time server dispatch, skipped if not given
+        amqp_port: Port of AQMP server
+        seed: Seed of the random number generator
+
+    Returns:
+        dict: Parameters, environment and timings
+    """
+    parameters = dict(dem_tiles=dem_tiles, tile_size=tile_size, resolution=resolution, buildings=buildings,
+                      rain_cells=rain_cells, timesteps=timesteps, runs=runs, repeat=repeat, seed=seed)
+    con = psycopg2.connect(dsn)
+    run_path = tempfile.mkdtemp()
+    results = {}
+    try:
+        run = create_dataset(con, dem_tiles=dem_tiles, tile_size=tile_size, resolution=resolution,
+                             buildings=buildings, rain_cells=rain_cells, timesteps=timesteps, seed=seed)
+        with con:
+            with con.cursor() as cur:
+                cur.execute(sql.SQL('DROP TABLE IF EXISTS {run_table}').format(
+                    run_table=sql.Identifier(run.run_table)))
+                cur.execute('SELECT version(), postgis_full_version()')
+                postgres_version, postgis_version = cur.fetchone()
+
+        results['get_dem'] = measure(lambda: run.get_dem(con), repeat)
+        results['get_dem_tiled'] = measure(lambda: run.get_dem(con, tiled=True), repeat)
+        results['get_rainfall'] = measure(lambda: run.get_rainfall(con), repeat)
+        results['get_domain'] = measure(lambda: run.get_domain(con), repeat)
+        results['get_buildings'] = measure(lambda: run.get_buildings(con), repeat)
+        results['get_green_areas'] = measure(lambda: run.get_green_areas(con), repeat)
+        results['get_model'] = measure(lambda: run.get_model(con), repeat)
+        results['write'] = measure(lambda: run.model.write(os.path.join(run_path, 'model')), repeat)
+
+        copies = [[copy_run(run) for _ in range(runs)] for _ in range(repeat)]
+        results['add'] = measure(lambda: [copy.add(con) for copy in copies.pop()], repeat)
+        copies = [[copy_run(run) for _ in range(runs)] for _ in range(repeat)]
+        run_ids = []
+        results['add_many'] = measure(lambda: run_ids.extend(add_many(con, copies.pop(), run.run_table)), repeat)
+        results['fetch'] = measure(lambda: [fetch(con, run_id, run.run_table) for run_id in run_ids[:runs]], repeat)
+        results['fetch_many'] = measure(lambda: list(fetch_many(con, run_ids[:runs], run.run_table)), repeat)
+
+        if amqp_host is not None:
+            results['dispatch'] = measure(lambda: dispatch(
+                con, run, max(runs // 100, 1), amqp_host, amqp_port, os.path.join(run_path, 'dispatch')), repeat)
+    finally:
+        con.close()
+        shutil.rmtree(run_path, ignore_errors=True)
+
+    return dict(
+        created=datetime.now().isoformat(),
+        parameters=parameters,
+        environment=dict(python=platform.python_version(), platform=platform.platform(),
+                         postgres=postgres_version, postgis=postgis_version),
+        results=results)
+
+
+def compare(results: dict, baseline: dict) -> dict:
+    """Calculate the ratio of each median duration to the baseline
+
+    Args:
+        results: Output of benchmark
+        baseline: Output of benchmark from a previous version
+
+    Returns:
+        dict: Ratio of each median duration to the baseline median duration
+    """
+    if results['parameters'] != baseline['parameters']:
+        warnings.warn('Benchmark parameters differ from the baseline')
+    return {name: result['median'] / baseline['results'][name]['median']
+            for name, result in results['results'].items() if name in baseline['results']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the citycatpg model preparation path')
+    parser.add_argument('--dsn', default='dbname=test user=postgres password=password host=localhost')
+    parser.add_argument('--dem-tiles', type=int, default=2)
+    parser.add_argument('--tile-size', type=int, default=250)
+    parser.add_argument('--resolution', type=float, default=5)
+    parser.add_argument('--buildings', type=int, default=1000)
+    parser.add_argument('--rain-cells', type=int, default=16)
+    parser.add_argument('--timesteps', type=int, default=288)
+    parser.add_argument('--runs', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--amqp-host')
+    parser.add_argument('--amqp-port', type=int, default=5672)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Path of the JSON file to create, printed if not given')
+    parser.add_argument('--baseline', help='Path of a previous JSON file to compare against')
+    args = parser.parse_args()
+
+    results = benchmark(args.dsn, args.dem_tiles, args.tile_size, args.resolution, args.buildings, args.rain_cells,
+                        args.timesteps, args.runs, args.repeat, args.amqp_host, args.amqp_port, args.seed)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            results['baseline'] = compare(results, json.load(f))
+
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
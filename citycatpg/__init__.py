@@ -1,4 +1,32 @@
-from .run import Run, fetch
-from .server import run_server
+import importlib
 
-__all__ = ['run_server', 'fetch', 'Run']
+# Attributes are imported from their module when first accessed, so that importing citycatpg to submit runs or
+# check the queue does not import geopandas, rasterio and citycatio
+_attributes = {
+    'Run': 'run', 'fetch': 'run', 'fetch_many': 'run', 'iter_runs': 'run', 'add_many': 'run', 'execute_many': 'run',
+    'DomainCache': 'cache', 'ResultCache': 'cache',
+    'InputStore': 'store',
+    'Metrics': 'metrics',
+    'Session': 'session',
+    'Sweep': 'sweep',
+    'run_server': 'server', 'run_queue_server': 'server',
+}
+_modules = ['pgqueue', 'scheduling', 'tiles', 'results']
+
+__all__ = ['run_server', 'run_queue_server', 'fetch', 'fetch_many', 'iter_runs', 'add_many', 'execute_many', 'Run',
+           'DomainCache', 'ResultCache', 'InputStore', 'Metrics', 'Sweep', 'Session']
+
+
+def __getattr__(name):
+    if name in _attributes:
+        value = getattr(importlib.import_module(f'.{_attributes[name]}', __name__), name)
+    elif name in _modules:
+        value = importlib.import_module(f'.{name}', __name__)
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_attributes) | set(_modules))
@@ -0,0 +1,146 @@
+"""Submit runs, start servers and check the status of runs from the command line
+
+Usage:
+    python -m citycatpg setup --dsn "dbname=test user=postgres password=password host=localhost"
+    python -m citycatpg submit 5a7c... 9e1f... --queue runs --host localhost
+    python -m citycatpg submit --pgqueue --run-table runs < run_ids.txt
+    python -m citycatpg worker --run-path runs --out-path outputs --queue runs --stage-ahead 2
+    python -m citycatpg worker --pgqueue --run-path runs --out-path outputs --workers 4
+    python -m citycatpg status --dsn "dbname=test user=postgres password=password host=localhost" --queue runs
+
+Only psycopg2 and pika are imported to submit runs and check their status, models are created by the worker
+"""
+from typing import Optional, List
+from datetime import timedelta
+import argparse
+import sys
+import pika
+import psycopg2
+
+_dsn = 'dbname=test user=postgres password=password host=localhost'
+
+
+def _setup(args: argparse.Namespace):
+    from . import pgqueue
+
+    con = psycopg2.connect(args.dsn)
+    try:
+        pgqueue.create_queue(con, args.run_table)
+    finally:
+        con.close()
+    print(f'Set up {args.run_table} as a queue')
+
+
+def _submit(args: argparse.Namespace):
+    run_ids = args.run_ids if args.run_ids else [line.strip() for line in sys.stdin if line.strip()]
+    if args.pgqueue:
+        from . import pgqueue
+
+        con = psycopg2.connect(args.dsn)
+        try:
+            pgqueue.enqueue(con, run_ids, args.run_table)
+        finally:
+            con.close()
+        print(f'Enqueued {len(run_ids)} runs in {args.run_table}')
+    else:
+        from .server import publish
+
+        print(f'Published {publish(run_ids, args.queue, args.host, args.port)} runs to {args.queue}')
+
+
+def _worker(args: argparse.Namespace):
+    from .server import run_server, run_queue_server
+
+    options = dict(store_path=args.store_path, metrics_table=args.metrics_table, metrics_port=args.metrics_port,
+                   results_table=args.results_table, load_results=args.load_results)
+    if args.pgqueue:
+        run_queue_server(args.dsn, args.run_path, args.out_path, args.run_table, args.workers or 1,
+                         timedelta(seconds=args.lease), args.poll_interval, args.close, **options)
+    else:
+        from .session import Session
+
+        session = Session(args.dsn)
+        try:
+            run_server(session, args.run_path, args.out_path, args.queue, args.host, args.port, args.close,
+                       args.workers, args.dsn if args.workers is not None or args.stage_ahead > 0 else None,
+                       args.stage_ahead, retries=args.retries, **options)
+        finally:
+            session.close()
+
+
+def _status(args: argparse.Namespace):
+    from . import pgqueue
+
+    con = psycopg2.connect(args.dsn)
+    try:
+        if pgqueue.is_queue(con, args.run_table):
+            for status, count in pgqueue.counts(con, args.run_table).items():
+                print(f'{status}\t{count}')
+        else:
+            print(f'{args.run_table} has not been set up as a queue, skipping the postgres counts', file=sys.stderr)
+    finally:
+        con.close()
+
+    if args.queue is not None:
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=args.host, port=args.port))
+        try:
+            method = connection.channel().queue_declare(queue=args.queue, durable=True).method
+            print(f'{args.queue}\t{method.message_count}')
+        finally:
+            connection.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog='citycatpg', description='Run CityCAT models from a PostgreSQL database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    setup = subparsers.add_parser(
+        'setup', help='Add the columns used to queue runs in postgres and record run times to the runs table')
+    setup.set_defaults(function=_setup)
+
+    submit = subparsers.add_parser('submit', help='Queue runs that have been added to the runs table')
+    submit.add_argument('run_ids', nargs='*', help='Unique identifiers of the runs, read from stdin if not given')
+    submit.set_defaults(function=_submit)
+
+    worker = subparsers.add_parser('worker', help='Execute queued runs')
+    worker.add_argument('--run-path', required=True)
+    worker.add_argument('--out-path', required=True)
+    worker.add_argument('--workers', type=int)
+    worker.add_argument('--stage-ahead', type=int, default=0)
+    worker.add_argument('--store-path')
+    worker.add_argument('--metrics-table')
+    worker.add_argument('--metrics-port', type=int)
+    worker.add_argument('--results-table')
+    worker.add_argument('--load-results', action='store_true')
+    worker.add_argument('--retries', type=int, default=2, help='Number of times a failed run is requeued')
+    worker.add_argument('--lease', type=float, default=600, help='Seconds before an unresponsive run is reclaimed')
+    worker.add_argument('--poll-interval', type=float, default=10)
+    worker.add_argument('--close', action='store_true', help='Stop when there are no queued runs')
+    worker.set_defaults(function=_worker)
+
+    status = subparsers.add_parser('status', help='Count the runs with each status')
+    status.set_defaults(function=_status)
+
+    for subparser in [setup, submit, worker, status]:
+        subparser.add_argument('--dsn', default=_dsn)
+        subparser.add_argument('--run-table', default='runs')
+        if subparser is setup:
+            continue
+        subparser.add_argument('--host', default='localhost')
+        subparser.add_argument('--port', type=int, default=5672)
+        if subparser is status:
+            subparser.add_argument('--queue', help='Also count the messages in this AQMP queue')
+        else:
+            subparser.add_argument('--queue', default='runs')
+            subparser.add_argument('--pgqueue', action='store_true',
+                                   help='Use the run_table as the queue instead of an AQMP server')
+
+    args = parser.parse_args(argv)
+    try:
+        args.function(args)
+    except (AssertionError, psycopg2.Error) as error:
+        sys.exit(f'{parser.prog} {args.command}: error: {error}')
+
+
+if __name__ == '__main__':
+    main()
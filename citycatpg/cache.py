@@ -0,0 +1,297 @@
+from collections import OrderedDict
+from typing import Optional, Callable, Any, Iterable, Tuple, Union
+from psycopg2.extensions import connection
+from psycopg2 import sql
+from .session import Session, _checkout
+import rasterio as rio
+import hashlib
+import json
+import pickle
+import threading
+import os
+
+
+def table_versions(con: connection, tables: Iterable[str]) -> dict:
+    """Get the modification counters of tables from the postgres statistics collector
+
+    Args:
+        con: Postgres connection
+        tables: Names of the tables
+
+    Returns:
+        dict: Number of inserted, updated and deleted rows for each table that exists
+    """
+    with con:
+        with con.cursor() as cur:
+            cur.execute("""
+            SELECT relname, n_tup_ins, n_tup_upd, n_tup_del
+            FROM pg_stat_user_tables
+            WHERE relname = ANY(%(tables)s)
+            """, dict(tables=list(tables)))
+            return {table: tuple(counters) for table, *counters in cur.fetchall()}
+
+
+def table_checksums(con: connection, tables: Iterable[str]) -> dict:
+    """Get a checksum of the contents of tables
+
+    Each table is read in full, so this is slower than table_versions but is not affected by
+    the statistics collector being reset or lagging behind committed changes
+
+    Args:
+        con: Postgres connection
+        tables: Names of the tables
+
+    Returns:
+        dict: MD5 digest of the rows of each table that exists, independent of the order in which they are stored
+    """
+    checksums = {}
+    with con:
+        with con.cursor() as cur:
+            for table in tables:
+                cur.execute('SELECT to_regclass(%(table)s) IS NOT NULL',
+                            dict(table=sql.Identifier(table).as_string(cur)))
+                if not cur.fetchone()[0]:
+                    continue
+                cur.execute(sql.SQL("""
+                SELECT md5(coalesce(string_agg(row_hash, '' ORDER BY row_hash), ''))
+                FROM (SELECT md5(rows::text) AS row_hash FROM {table} AS rows) AS hashes
+                """).format(table=sql.Identifier(table)))
+                checksums[table] = cur.fetchone()[0]
+    return checksums
+
+
+def _digest(value) -> str:
+    return hashlib.md5(repr(value).encode()).hexdigest()[:16]
+
+
+class _Raster:
+    def __init__(self, data: rio.MemoryFile):
+        self.data = bytes(data.getbuffer())
+
+
+class DomainCache:
+    """Cache of the domain inputs shared between runs
+
+    Inputs are keyed by (input, table, domain_table, domain_id).
+    The most recently used inputs are kept in memory and, if a path is given,
+    every input is also stored on disk so that it can be shared between processes.
+
+    Args:
+        maxsize: Maximum number of inputs to keep in memory
+        path: Directory in which to store inputs on disk
+    """
+    def __init__(self, maxsize: int = 32, path: Optional[str] = None):
+        self.maxsize = maxsize
+        self.path = path
+        self._items = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+        if path is not None:
+            if not os.path.exists(path):
+                os.mkdir(path)
+            if os.path.exists(self._versions_path):
+                with open(self._versions_path, 'rb') as f:
+                    self._versions = pickle.load(f)
+
+    @property
+    def _versions_path(self):
+        return os.path.join(self.path, 'versions.pkl')
+
+    def _file_path(self, key: tuple) -> str:
+        _, table, domain_table, _ = key
+        return os.path.join(self.path, f'{_digest(table)}-{_digest(domain_table)}-{_digest(key)}.pkl')
+
+    def _remember(self, key: tuple, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def get(self, key: tuple, loader: Callable[[], Any]):
+        """Get an input from the cache, loading it if it is missing
+
+        Args:
+            key: Tuple of (input, table, domain_table, domain_id)
+            loader: Function returning the input if it is not in the cache
+
+        Returns:
+            The cached input
+        """
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+
+        if value is None and self.path is not None and os.path.exists(self._file_path(key)):
+            with open(self._file_path(key), 'rb') as f:
+                value = pickle.load(f)
+            self._remember(key, value)
+
+        if value is None:
+            value = loader()
+            if type(value) == rio.MemoryFile:
+                value = _Raster(value)
+            if self.path is not None:
+                temp_path = f'{self._file_path(key)}.{os.getpid()}.tmp'
+                with open(temp_path, 'wb') as f:
+                    pickle.dump(value, f)
+                os.replace(temp_path, self._file_path(key))
+            self._remember(key, value)
+
+        if type(value) == _Raster:
+            return rio.MemoryFile(value.data)
+        return value
+
+    def invalidate(self, table: Optional[str] = None):
+        """Remove inputs created from a table
+
+        Args:
+            table: Name of the input or domain table, all inputs are removed if not given
+        """
+        with self._lock:
+            for key in list(self._items.keys()):
+                if table is None or table in key[1:3]:
+                    del self._items[key]
+
+        if self.path is not None:
+            for file_name in os.listdir(self.path):
+                if not file_name.endswith('.pkl') or file_name == os.path.basename(self._versions_path):
+                    continue
+                if table is None or _digest(table) in file_name.split('-')[:2]:
+                    os.remove(os.path.join(self.path, file_name))
+
+    def refresh(self, con: connection):
+        """Remove inputs whose source tables have been modified since the last refresh
+
+        Args:
+            con: Postgres connection
+        """
+        with self._lock:
+            tables = {table for key in self._items for table in key[1:3]}
+        tables.update(self._versions.keys())
+
+        versions = table_versions(con, tables)
+        for table, version in versions.items():
+            if table in self._versions and self._versions[table] != version:
+                self.invalidate(table)
+        self._versions.update(versions)
+
+        if self.path is not None:
+            with open(self._versions_path, 'wb') as f:
+                pickle.dump(self._versions, f)
+
+
+_result_fields = ['run_duration', 'output_frequency', 'domain_table', 'domain_id', 'dem_table', 'rain_table',
+                  'rain_start', 'rain_end', 'rain_total', 'rain_duration', 'friction', 'green_areas_table',
+                  'buildings_table', 'metadata_table']
+
+
+class ResultCache:
+    """Cache of model outputs keyed by a hash of the run configuration and the versions of its input tables
+
+    Runs with the same configuration reuse the netCDF and GeoTIFF files of the first run to be executed,
+    linking them to their own output file names, instead of executing CityCAT again.
+
+    By default the versions of the input tables are the insert, update and delete counters of the postgres
+    statistics collector, see table_versions. These counters are not transactional, are updated asynchronously and
+    are cleared by pg_stat_reset or a crash, so outputs may be reused after an input table has changed.
+    Use checksum=True to hash the contents of the input tables instead, at the cost of reading them for each key
+
+    Args:
+        con: Postgres connection, or a Session so that one cache can be shared by threads
+        table: Postgres table in which to store the outputs of each configuration
+        checksum: Whether to version the input tables using table_checksums rather than table_versions
+    """
+    def __init__(self, con: Union[connection, Session], table: str = 'run_results', checksum: bool = False):
+        self.con = con
+        self.table = table
+        self.checksum = checksum
+        self._executables = {}
+
+        with _checkout(con) as con:
+            with con:
+                with con.cursor() as cur:
+                    cur.execute(sql.SQL("""
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        config_hash text PRIMARY KEY,
+                        run_id uuid,
+                        netcdf text,
+                        geotiff text,
+                        created timestamp DEFAULT now()
+                    )
+                    """).format(table=sql.Identifier(table)))
+
+    def key(self, run) -> str:
+        """Create a hash of the configuration of a run
+
+        Args:
+            run: Run configuration
+
+        Returns:
+            str: SHA-256 digest of the configuration, input table versions and CityCAT executable
+        """
+        config = {name: getattr(run, name) for name in _result_fields}
+        tables = [config[name] for name in _result_fields if name.endswith('_table') and config[name] is not None]
+        # Compacted rainfall is read from the chunks table, which is skipped by the versions if it does not exist
+        if run.rain_table is not None:
+            tables.append(f'{run.rain_table}_chunks')
+        versions = table_checksums if self.checksum else table_versions
+        with _checkout(self.con) as con:
+            config['versions'] = sorted(versions(con, tables).items())
+        config['executable'] = self._executable_digest(os.getenv('CITYCAT'))
+        return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _executable_digest(self, executable: Optional[str]) -> Optional[str]:
+        if executable is None or not os.path.exists(executable):
+            return None
+        stat = os.stat(executable)
+        key = (os.path.abspath(executable), stat.st_size, stat.st_mtime)
+        if key not in self._executables:
+            digest = hashlib.sha256()
+            with open(executable, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            self._executables[key] = digest.hexdigest()
+        return self._executables[key]
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """Get the outputs of a previous run with the same configuration
+
+        Args:
+            key: Hash of the configuration created using the key method
+
+        Returns:
+            Tuple[str, str]: Paths of the netCDF and GeoTIFF files if they exist
+        """
+        with _checkout(self.con) as con:
+            with con:
+                with con.cursor() as cur:
+                    cur.execute(sql.SQL('SELECT netcdf, geotiff FROM {table} WHERE config_hash = %(key)s').format(
+                        table=sql.Identifier(self.table)), dict(key=key))
+                    row = cur.fetchone()
+        if row is not None and all(os.path.exists(path) for path in row):
+            return row
+        return None
+
+    def add(self, key: str, run, netcdf: str, geotiff: str):
+        """Store the outputs of a run
+
+        Args:
+            key: Hash of the configuration created using the key method before the run was executed
+            run: Run configuration
+            netcdf: Path of the netCDF file
+            geotiff: Path of the GeoTIFF file
+        """
+        with _checkout(self.con) as con:
+            with con:
+                with con.cursor() as cur:
+                    cur.execute(sql.SQL("""
+                    INSERT INTO {table} (config_hash, run_id, netcdf, geotiff) VALUES (%(key)s, %(run_id)s, %(netcdf)s,
+                        %(geotiff)s)
+                    ON CONFLICT (config_hash) DO UPDATE
+                    SET run_id = excluded.run_id, netcdf = excluded.netcdf, geotiff = excluded.geotiff, created = now()
+                    """).format(table=sql.Identifier(self.table)),
+                        dict(key=key, run_id=run.run_id, netcdf=os.path.abspath(netcdf),
+                             geotiff=os.path.abspath(geotiff)))
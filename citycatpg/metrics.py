@@ -0,0 +1,161 @@
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable
+from psycopg2.extensions import connection
+from psycopg2.extras import execute_values
+from psycopg2 import sql
+import threading
+import time
+import os
+
+
+class Metrics:
+    """Durations, row counts and byte counts of the phases of one or more runs
+
+    Args:
+        keep_phases: Whether to keep each phase as well as the running totals, servers only keep the totals
+
+    Attributes:
+        phases (list): Dictionaries containing the phase, start, seconds, rows and bytes of each timed phase
+    """
+    def __init__(self, keep_phases: bool = True):
+        self.phases = []
+        self.keep_phases = keep_phases
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return dict(phases=self.phases, keep_phases=self.keep_phases, totals=self._totals)
+
+    def __setstate__(self, state):
+        self.phases = state['phases']
+        self.keep_phases = state['keep_phases']
+        self._totals = state['totals']
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time a phase, the rows and bytes items of the yielded dictionary can be set to record counts
+
+        Args:
+            name: Name of the phase
+        """
+        record = dict(phase=name, start=datetime.now(), seconds=None, rows=None, bytes=None)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self.extend([record])
+
+    def extend(self, phases: Iterable[dict]):
+        """Add phases recorded elsewhere, for example in another process
+
+        Args:
+            phases: Dictionaries as stored in the phases attribute
+        """
+        with self._lock:
+            for record in phases:
+                total = self._totals.setdefault(record['phase'], dict(count=0, seconds=0, rows=0, bytes=0))
+                total['count'] += 1
+                for key in ['seconds', 'rows', 'bytes']:
+                    total[key] += record[key] or 0
+                if self.keep_phases:
+                    self.phases.append(record)
+
+    def totals(self) -> dict:
+        """Totals of the phases by name, kept up to date as phases are added
+
+        Returns:
+            dict: Count, seconds, rows and bytes of each phase
+        """
+        with self._lock:
+            return {phase: dict(total) for phase, total in self._totals.items()}
+
+    def to_text(self, prefix: str = 'citycatpg') -> str:
+        """Export the totals of each phase in the Prometheus text format
+
+        Args:
+            prefix: Prefix of each metric name
+
+        Returns:
+            str: Metrics in the Prometheus text format
+        """
+        lines = []
+        totals = self.totals()
+        for key in ['count', 'seconds', 'rows', 'bytes']:
+            name = f'{prefix}_phase_{key}_total'
+            lines.append(f'# TYPE {name} counter')
+            lines.extend(f'{name}{{phase="{phase}"}} {total[key]}' for phase, total in totals.items())
+        return '\n'.join(lines) + '\n'
+
+    def save(self, con: connection, run_id: str, table: str = 'run_metrics'):
+        """Insert the phases into the metrics table
+
+        Args:
+            con: Postgres connection
+            run_id: Unique identifier for the run
+            table: Postgres table where the metrics are stored
+        """
+        with con:
+            with con.cursor() as cur:
+                cur.execute(sql.SQL("""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    run_id uuid,
+                    phase text,
+                    start timestamp,
+                    seconds double precision,
+                    rows bigint,
+                    bytes bigint
+                );
+                CREATE INDEX IF NOT EXISTS {index} ON {table} (run_id);
+                """).format(table=sql.Identifier(table), index=sql.Identifier(f'{table}_run_id_idx')))
+
+                with self._lock:
+                    rows = [(run_id, record['phase'], record['start'], record['seconds'], record['rows'],
+                             record['bytes']) for record in self.phases]
+                execute_values(cur, sql.SQL('INSERT INTO {table} VALUES %s').format(
+                    table=sql.Identifier(table)).as_string(cur), rows)
+
+
+def serve_metrics(metrics: Metrics, port: int, host: str = '') -> ThreadingHTTPServer:
+    """Serve metrics in the Prometheus text format from a background thread
+
+    Args:
+        metrics: Metrics to serve
+        port: Port to listen on
+        host: Hostname to listen on
+
+    Returns:
+        http.server.ThreadingHTTPServer: Server that can be stopped using shutdown
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.to_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _counts(value) -> dict:
+    if type(value) == tuple:
+        value = value[0]
+    if hasattr(value, 'getbuffer'):
+        return dict(bytes=len(value.getbuffer()))
+    if hasattr(value, 'shape'):
+        return dict(rows=value.shape[0])
+    return {}
+
+
+def _directory_size(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
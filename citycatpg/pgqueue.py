@@ -0,0 +1,182 @@
+from datetime import timedelta
+from typing import Iterable, List, Optional, Dict, TYPE_CHECKING
+from psycopg2.extensions import connection, cursor
+from psycopg2 import sql
+
+if TYPE_CHECKING:
+    from .run import Run
+
+
+_queue_columns = ['status', 'worker', 'heartbeat', 'priority']
+
+
+def create_queue(con: connection, run_table: str = 'runs'):
+    """Add the status, worker, heartbeat and priority columns used to claim runs to the run_table
+
+    The run_start and run_end columns are also added to run tables created by earlier versions.
+    This locks the run_table and requires its owner, so it is called once by run_queue_server
+    or using python -m citycatpg setup rather than each time runs are enqueued
+
+    Args:
+        con: Postgres connection
+        run_table: Postgres table where the run configurations are stored
+    """
+    with con:
+        with con.cursor() as cur:
+            cur.execute(sql.SQL("""
+            ALTER TABLE {run_table}
+                ADD COLUMN IF NOT EXISTS run_start timestamp,
+                ADD COLUMN IF NOT EXISTS run_end timestamp,
+                ADD COLUMN IF NOT EXISTS status text,
+                ADD COLUMN IF NOT EXISTS worker text,
+                ADD COLUMN IF NOT EXISTS heartbeat timestamp,
+                ADD COLUMN IF NOT EXISTS priority double precision;
+            CREATE INDEX IF NOT EXISTS {index} ON {run_table} (status) WHERE status IN ('pending', 'running');
+            """).format(
+                run_table=sql.Identifier(run_table),
+                index=sql.Identifier(f'{run_table}_status_idx')))
+
+
+def _has_queue(cur: cursor, run_table: str) -> bool:
+    cur.execute("""
+    SELECT count(*) FROM information_schema.columns
+    WHERE table_name = %(run_table)s AND column_name = ANY(%(columns)s)
+    """, dict(run_table=run_table, columns=_queue_columns))
+    return cur.fetchone()[0] == len(_queue_columns)
+
+
+def _check_queue(cur: cursor, run_table: str):
+    assert _has_queue(cur, run_table), f'{run_table} has not been set up as a queue, see create_queue'
+
+
+def is_queue(con: connection, run_table: str = 'runs') -> bool:
+    """Check whether the run_table has been set up as a queue using create_queue
+
+    Args:
+        con: Postgres connection
+        run_table: Postgres table where the run configurations are stored
+
+    Returns:
+        bool: Whether the run_table has the columns used to claim runs
+    """
+    with con:
+        with con.cursor() as cur:
+            return _has_queue(cur, run_table)
+
+
+def enqueue(con: connection, run_ids: Iterable[str], run_table: str = 'runs',
+            priorities: Optional[Iterable[float]] = None):
+    """Mark runs as pending so that they can be claimed by a server
+
+    The run_table must have been set up using create_queue
+
+    Args:
+        con: Postgres connection
+        run_ids: Unique identifiers of the runs
+        run_table: Postgres table where the run configurations are stored
+        priorities: Priority of each run, runs with higher priorities are claimed first, see scheduling.enqueue
+    """
+    run_ids = list(run_ids)
+    priorities = list(priorities) if priorities is not None else [None] * len(run_ids)
+    assert len(priorities) == len(run_ids), 'A priority is required for each run'
+    with con:
+        with con.cursor() as cur:
+            _check_queue(cur, run_table)
+            cur.execute(sql.SQL("""
+            UPDATE {run_table} SET status = 'pending', worker = NULL, heartbeat = NULL, priority = queued.priority
+            FROM unnest(%(run_ids)s::uuid[], %(priorities)s::float8[]) AS queued (run_id, priority)
+            WHERE {run_table}.run_id = queued.run_id
+            """).format(run_table=sql.Identifier(run_table)), dict(run_ids=run_ids, priorities=priorities))
+
+
+def claim(con: connection, worker: str, batch_size: int = 1, lease: timedelta = timedelta(minutes=10),
+          run_table: str = 'runs') -> List['Run']:
+    """Claim pending runs, skipping runs that are locked by other workers
+
+    Runs with the highest priority are claimed first.
+    Runs whose worker has not sent a heartbeat within the lease are claimed again
+
+    Args:
+        con: Postgres connection
+        worker: Name of the worker claiming the runs
+        batch_size: Maximum number of runs to claim
+        lease: Time after the last heartbeat before a running run can be claimed by another worker
+        run_table: Postgres table where the run configurations are stored
+
+    Returns:
+        List[Run]: Configurations of the claimed runs
+    """
+    from .run import _columns, _from_row
+
+    with con:
+        with con.cursor() as cur:
+            cur.execute(sql.SQL("""
+            UPDATE {run_table} SET status = 'running', worker = %(worker)s, heartbeat = now()
+            WHERE run_id IN (
+                SELECT run_id FROM {run_table}
+                WHERE status = 'pending' OR (status = 'running' AND heartbeat < now() - %(lease)s)
+                ORDER BY priority DESC NULLS LAST
+                LIMIT %(batch_size)s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING {columns}
+            """).format(
+                run_table=sql.Identifier(run_table),
+                columns=sql.SQL(', ').join(map(sql.Identifier, _columns))),
+                dict(worker=worker, lease=lease, batch_size=batch_size))
+            return [_from_row(row, run_table) for row in cur.fetchall()]
+
+
+def heartbeat(con: connection, worker: str, run_ids: Iterable[str], run_table: str = 'runs'):
+    """Extend the lease of runs claimed by a worker
+
+    Args:
+        con: Postgres connection
+        worker: Name of the worker that claimed the runs
+        run_ids: Unique identifiers of the runs
+        run_table: Postgres table where the run configurations are stored
+    """
+    with con:
+        with con.cursor() as cur:
+            cur.execute(sql.SQL("""
+            UPDATE {run_table} SET heartbeat = now()
+            WHERE run_id = ANY(%(run_ids)s::uuid[]) AND worker = %(worker)s AND status = 'running'
+            """).format(run_table=sql.Identifier(run_table)), dict(worker=worker, run_ids=list(run_ids)))
+
+
+def complete(con: connection, worker: str, run_id: str, status: str = 'complete', run_table: str = 'runs'):
+    """Set the final status of a run claimed by a worker
+
+    Args:
+        con: Postgres connection
+        worker: Name of the worker that claimed the run
+        run_id: Unique identifier of the run
+        status: Final status of the run, either complete or failed
+        run_table: Postgres table where the run configurations are stored
+    """
+    assert status in ['complete', 'failed'], 'Status must be complete or failed'
+    with con:
+        with con.cursor() as cur:
+            cur.execute(sql.SQL("""
+            UPDATE {run_table} SET status = %(status)s, heartbeat = now()
+            WHERE run_id = %(run_id)s AND worker = %(worker)s
+            """).format(run_table=sql.Identifier(run_table)), dict(worker=worker, run_id=run_id, status=status))
+
+
+def counts(con: connection, run_table: str = 'runs') -> Dict[str, int]:
+    """Count the runs with each status
+
+    Args:
+        con: Postgres connection
+        run_table: Postgres table where the run configurations are stored
+
+    Returns:
+        Dict[str, int]: Number of runs with each status, runs that have never been enqueued have the status new
+    """
+    with con:
+        with con.cursor() as cur:
+            _check_queue(cur, run_table)
+            cur.execute(sql.SQL("""
+            SELECT coalesce(status, 'new'), count(*) FROM {run_table} GROUP BY 1 ORDER BY 1
+            """).format(run_table=sql.Identifier(run_table)))
+            return dict(cur.fetchall())
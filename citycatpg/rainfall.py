@@ -0,0 +1,100 @@
+"""Convert gridded rainfall from numeric[] series to float32 chunks read by Run.get_rainfall
+
+Usage:
+    python -m citycatpg.rainfall --dsn "dbname=test user=postgres password=password host=localhost" \\
+        --rain-table rain --chunk-size 288
+"""
+from psycopg2.extensions import connection
+from psycopg2 import sql
+import argparse
+import io
+import uuid
+import numpy as np
+import psycopg2
+
+
+def compact(con: connection, rain_table: str, metadata_table: str = 'metadata', chunk_size: int = 288,
+            itersize: int = 1000, drop_series: bool = False) -> int:
+    """Store the series of each rainfall cell as chunks of little-endian float32 values
+
+    Chunks are stored in the {rain_table}_chunks table, keyed by the gid of the cell and the index of the chunk.
+    The last chunk of each cell is padded with NaN. The chunk_size is stored in the metadata_table so that
+    Run.get_rainfall only reads the chunks covering the rainfall event. Existing chunks are replaced.
+
+    Args:
+        con: Postgres connection
+        rain_table: Postgres table containing the gid, geom and series of each rainfall cell
+        metadata_table: Postgres table containing the start and frequency of the rain_table
+        chunk_size: Number of time steps in each chunk
+        itersize: Number of cells read from the rain_table at a time
+        drop_series: Whether to drop the series column of the rain_table once it has been converted
+
+    Returns:
+        int: Number of chunks created
+    """
+    chunks_table = f'{rain_table}_chunks'
+    with con:
+        with con.cursor() as cur:
+            cur.execute(sql.SQL("""
+            DROP TABLE IF EXISTS {chunks_table};
+            CREATE TABLE {chunks_table} (gid integer, chunk integer, data bytea, PRIMARY KEY (gid, chunk));
+            ALTER TABLE {metadata_table} ADD COLUMN IF NOT EXISTS chunk_size integer;
+            """).format(
+                chunks_table=sql.Identifier(chunks_table),
+                metadata_table=sql.Identifier(metadata_table)))
+
+        count = 0
+        with con.cursor(name=f'citycatpg_{uuid.uuid4().hex}') as cur:
+            cur.itersize = itersize
+            cur.execute(sql.SQL('SELECT gid, series::float4[] FROM {rain_table}').format(
+                rain_table=sql.Identifier(rain_table)))
+
+            with con.cursor() as copy_cur:
+                while True:
+                    rows = cur.fetchmany(itersize)
+                    if len(rows) == 0:
+                        break
+                    buffer = io.StringIO()
+                    for gid, series in rows:
+                        values = np.array([np.nan if value is None else value for value in series], dtype='<f4')
+                        values = np.pad(values, (0, -len(values) % chunk_size), constant_values=np.nan)
+                        for chunk, data in enumerate(values.reshape(-1, chunk_size)):
+                            buffer.write(f'{gid}\t{chunk}\t\\\\x{data.tobytes().hex()}\n')
+                            count += 1
+                    buffer.seek(0)
+                    copy_cur.copy_expert(sql.SQL('COPY {chunks_table} (gid, chunk, data) FROM STDIN').format(
+                        chunks_table=sql.Identifier(chunks_table)).as_string(copy_cur), buffer)
+
+        with con.cursor() as cur:
+            cur.execute(sql.SQL("""
+            UPDATE {metadata_table} SET chunk_size = %(chunk_size)s WHERE dataset = %(rain_table)s;
+            ANALYZE {chunks_table};
+            """).format(
+                metadata_table=sql.Identifier(metadata_table),
+                chunks_table=sql.Identifier(chunks_table)), dict(chunk_size=chunk_size, rain_table=rain_table))
+            if drop_series:
+                cur.execute(sql.SQL('ALTER TABLE {rain_table} DROP COLUMN series').format(
+                    rain_table=sql.Identifier(rain_table)))
+
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert gridded rainfall to float32 chunks')
+    parser.add_argument('--dsn', default='dbname=test user=postgres password=password host=localhost')
+    parser.add_argument('--rain-table', required=True)
+    parser.add_argument('--metadata-table', default='metadata')
+    parser.add_argument('--chunk-size', type=int, default=288)
+    parser.add_argument('--drop-series', action='store_true')
+    args = parser.parse_args()
+
+    con = psycopg2.connect(args.dsn)
+    try:
+        count = compact(con, args.rain_table, args.metadata_table, args.chunk_size, drop_series=args.drop_series)
+        print(f'Created {count} chunks in {args.rain_table}_chunks')
+    finally:
+        con.close()
+
+
+if __name__ == '__main__':
+    main()
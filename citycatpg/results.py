@@ -0,0 +1,157 @@
+from .run import Run
+from typing import Iterator, Tuple, Optional
+from psycopg2.extensions import connection
+from psycopg2 import sql
+from rasterio.features import rasterize
+from rasterio.windows import Window
+from rasterio.transform import Affine
+from shapely import wkb
+import rasterio as rio
+import numpy as np
+import pandas as pd
+import io
+import os
+import struct
+
+_pixel_types = {np.dtype('float32'): (10, 'f'), np.dtype('float64'): (11, 'd')}
+
+
+def _raster_wkb(array: np.ndarray, transform: Affine, srid: int, nodata: Optional[float]) -> bytes:
+    pixel_type, nodata_format = _pixel_types[array.dtype]
+    header = struct.pack('<BHHddddddiHH', 1, 0, 1, transform.a, transform.e, transform.c, transform.f,
+                         transform.b, transform.d, srid, array.shape[1], array.shape[0])
+    band = struct.pack(f'<B{nodata_format}', pixel_type | (0x40 if nodata is not None else 0),
+                       nodata if nodata is not None else 0)
+    return header + band + array.astype(array.dtype.newbyteorder('<')).tobytes()
+
+
+def _tiles(file_path: str, tile_size: int) -> Iterator[Tuple[np.ndarray, Affine, float]]:
+    with rio.open(file_path) as src:
+        for row in range(0, src.height, tile_size):
+            for col in range(0, src.width, tile_size):
+                window = Window(col, row, min(tile_size, src.width - col), min(tile_size, src.height - row))
+                yield src.read(1, window=window), src.window_transform(window), src.nodata
+
+
+def _srid(con: connection, run: Run) -> int:
+    with con:
+        with con.cursor() as cur:
+            cur.execute(sql.SQL('SELECT ST_SRID(geom) FROM {domain_table} WHERE gid = %(domain_id)s').format(
+                domain_table=sql.Identifier(run.domain_table)), run.__dict__)
+            assert cur.rowcount == 1, f'Domain {run.domain_id} missing from {run.domain_table}'
+            return cur.fetchone()[0]
+
+
+def load_max_depth(con: connection, run: Run, out_path: str, table: str = 'max_depth', tile_size: int = 256):
+    """Load the maximum depth GeoTIFF of a run into a postgis raster table using COPY
+
+    Existing tiles of the run are replaced
+
+    Args:
+        con: Postgres connection
+        run: Configuration of a run that has been executed
+        out_path: Directory containing the output GeoTIFF file
+        table: Postgres table in which to store the raster tiles
+        tile_size: Number of cells along each side of a tile
+    """
+    srid = _srid(con, run)
+    buffer = io.StringIO()
+    for array, transform, nodata in _tiles(os.path.join(out_path, f'{run.run_name}-{run.run_id}.tif'), tile_size):
+        buffer.write(f'{run.run_id}\t{_raster_wkb(array, transform, srid, nodata).hex()}\n')
+    buffer.seek(0)
+
+    with con:
+        with con.cursor() as cur:
+            cur.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {table} (rid serial PRIMARY KEY, run_id uuid, rast raster);
+            CREATE INDEX IF NOT EXISTS {run_index} ON {table} (run_id);
+            CREATE INDEX IF NOT EXISTS {rast_index} ON {table} USING gist (ST_ConvexHull(rast));
+            DELETE FROM {table} WHERE run_id = %(run_id)s;
+            """).format(
+                table=sql.Identifier(table),
+                run_index=sql.Identifier(f'{table}_run_id_idx'),
+                rast_index=sql.Identifier(f'{table}_rast_idx')), run.__dict__)
+            cur.copy_expert(sql.SQL('COPY {table} (run_id, rast) FROM STDIN').format(
+                table=sql.Identifier(table)).as_string(cur), buffer)
+
+
+def zonal_max(con: connection, run: Run, out_path: str, source_table: str) -> pd.DataFrame:
+    """Calculate the maximum depth within each polygon of a table that intersects the domain
+
+    Polygons are rasterized onto the grid of the maximum depth GeoTIFF, including every cell they touch
+
+    Args:
+        con: Postgres connection
+        run: Configuration of a run that has been executed
+        out_path: Directory containing the output GeoTIFF file
+        source_table: Postgres table containing the polygons, such as the buildings_table
+
+    Returns:
+        pandas.DataFrame: Maximum depth of each gid, polygons without any wet cells are omitted
+    """
+    with con:
+        with con.cursor() as cur:
+            cur.execute(sql.SQL("""
+            SELECT {source_table}.gid, ST_AsBinary({source_table}.geom)
+            FROM {source_table}, {domain_table}
+            WHERE ST_Intersects({source_table}.geom, {domain_table}.geom) AND {domain_table}.gid = %(domain_id)s
+            """).format(
+                source_table=sql.Identifier(source_table),
+                domain_table=sql.Identifier(run.domain_table)), run.__dict__)
+            rows = cur.fetchall()
+
+    with rio.open(os.path.join(out_path, f'{run.run_name}-{run.run_id}.tif')) as src:
+        depth = src.read(1)
+        labels = rasterize(((wkb.loads(bytes(geom)), index + 1) for index, (_, geom) in enumerate(rows)),
+                           out_shape=depth.shape, transform=src.transform, fill=0, all_touched=True,
+                           dtype='int32') if len(rows) > 0 else np.zeros(depth.shape, dtype='int32')
+        valid = (labels > 0) & (depth != src.nodata) & ~np.isnan(depth)
+
+    gids = np.array([gid for gid, _ in rows])
+    cells = pd.DataFrame(dict(gid=gids[labels[valid] - 1] if len(rows) > 0 else [], max_depth=depth[valid]))
+    return cells.groupby('gid', as_index=False).max()
+
+
+def write_results(con: connection, run: Run, out_path: str, raster_table: str = 'max_depth',
+                  features_table: str = 'max_depth_features', tile_size: int = 256):
+    """Load the maximum depth of a run and the maximum depth of each of its buildings and green areas into postgres
+
+    Existing results of the run are replaced
+
+    Args:
+        con: Postgres connection
+        run: Configuration of a run that has been executed
+        out_path: Directory containing the output GeoTIFF file
+        raster_table: Postgres table in which to store the maximum depth raster tiles, see load_max_depth
+        features_table: Postgres table in which to store the maximum depth of each building and green area
+        tile_size: Number of cells along each side of a raster tile
+    """
+    load_max_depth(con, run, out_path, raster_table, tile_size)
+
+    buffer = io.StringIO()
+    for source_table in [run.buildings_table, run.green_areas_table]:
+        if source_table is not None:
+            depths = zonal_max(con, run, out_path, source_table)
+            depths.insert(0, 'source_table', source_table)
+            depths.insert(0, 'run_id', run.run_id)
+            depths.to_csv(buffer, sep='\t', header=False, index=False)
+    buffer.seek(0)
+
+    with con:
+        with con.cursor() as cur:
+            cur.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {table} (
+                run_id uuid,
+                source_table text,
+                gid integer,
+                max_depth double precision
+            );
+            CREATE INDEX IF NOT EXISTS {run_index} ON {table} (run_id);
+            CREATE INDEX IF NOT EXISTS {feature_index} ON {table} (source_table, gid);
+            DELETE FROM {table} WHERE run_id = %(run_id)s;
+            """).format(
+                table=sql.Identifier(features_table),
+                run_index=sql.Identifier(f'{features_table}_run_id_idx'),
+                feature_index=sql.Identifier(f'{features_table}_feature_idx')), run.__dict__)
+            cur.copy_expert(sql.SQL('COPY {table} (run_id, source_table, gid, max_depth) FROM STDIN').format(
+                table=sql.Identifier(features_table)).as_string(cur), buffer)
@@ -1,18 +1,140 @@
 import shutil
 from dataclasses import dataclass, field
-from typing import Optional
-from datetime import datetime
+from typing import Optional, Iterable, Iterator, List, Dict, Callable, Union, Tuple
+from datetime import datetime, timedelta
 from psycopg2.extensions import connection
 import uuid
+import functools
 from psycopg2 import sql
 from citycatio import Model
 from citycatio.output import to_netcdf, to_geotiff
 import pandas as pd
+import numpy as np
 import rasterio as rio
+from rasterio.transform import Affine
+from rasterio.windows import Window, from_bounds
 import geopandas as gpd
+from shapely import wkb
 import os
+import math
 import subprocess
+import asyncio
 import warnings
+from psycopg2.extras import execute_values
+from psycopg2.pool import AbstractConnectionPool, ThreadedConnectionPool
+from concurrent.futures import ThreadPoolExecutor
+from .cache import DomainCache, ResultCache
+from .streaming import NetCDFStream
+from .store import InputStore
+from .metrics import Metrics, _counts, _directory_size
+from .session import Session, _checkout, _execute
+
+_columns = [
+    'run_id',
+    'run_duration',
+    'run_name',
+    'run_start',
+    'run_end',
+    'domain_table',
+    'domain_id',
+    'dem_table',
+    'rain_table',
+    'rain_start',
+    'rain_end',
+    'output_frequency',
+    'rain_total',
+    'rain_duration',
+    'friction',
+    'green_areas_table',
+    'buildings_table',
+    'version_number'
+]
+
+
+def _get_inputs(con: Optional[connection], getters: Dict[str, Callable],
+                pool: Optional[Union[AbstractConnectionPool, str]]) -> dict:
+    if pool is None:
+        return {name: getter(con) for name, getter in getters.items()}
+
+    close = isinstance(pool, str)
+    if close:
+        pool = ThreadedConnectionPool(1, len(getters), pool)
+
+    def get_input(getter):
+        pool_con = pool.getconn()
+        try:
+            return getter(pool_con)
+        finally:
+            pool.putconn(pool_con)
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(getters)) as executor:
+            futures = {name: executor.submit(get_input, getter) for name, getter in getters.items()}
+            return {name: future.result() for name, future in futures.items()}
+    finally:
+        if close:
+            pool.closeall()
+
+
+def _snap_to_grid(res_x: float, res_y: float, left: float, top: float, right: float, bottom: float,
+                  x_min: float, y_min: float, x_max: float, y_max: float):
+    res_y = abs(res_y)
+    left, right = (
+        max(left, left + math.floor((x_min - left) / res_x) * res_x),
+        min(right, left + math.ceil((x_max - left) / res_x) * res_x))
+    top, bottom = (
+        min(top, top - math.floor((top - y_max) / res_y) * res_y),
+        max(bottom, top - math.ceil((top - y_min) / res_y) * res_y))
+
+    return (Affine.translation(left, top) * Affine.scale(res_x, -res_y),
+            int(round((right - left) / res_x)), int(round((top - bottom) / res_y)))
+
+
+def _mosaic(tiles: Iterable[memoryview], transform: Affine, width: int, height: int) -> rio.MemoryFile:
+    output = rio.MemoryFile()
+    dataset = None
+    try:
+        for tile in tiles:
+            with rio.MemoryFile(tile) as tile_file, tile_file.open() as src:
+                if dataset is None:
+                    dataset = output.open(driver='GTiff', width=width, height=height, count=1,
+                                          dtype=src.dtypes[0], crs=src.crs, transform=transform, nodata=src.nodata)
+
+                window = from_bounds(*src.bounds, transform=transform)
+                window = Window(round(window.col_off), round(window.row_off), src.width, src.height)
+                data = src.read(1, masked=True)
+                dataset.write(np.where(data.mask, dataset.read(1, window=window), data.data), 1, window=window)
+    finally:
+        if dataset is not None:
+            dataset.close()
+
+    assert dataset is not None, 'DEM does not intersect the domain'
+    return output
+
+
+def _create_table(run_table: str):
+    return sql.SQL("""
+    CREATE TABLE IF NOT EXISTS {run_table} (
+        run_id uuid PRIMARY KEY,
+        run_duration int,
+        run_name text,
+        run_start timestamp,
+        run_end timestamp,
+        domain_table text,
+        domain_id int,
+        dem_table text,
+        rain_table text,
+        rain_start timestamp,
+        rain_end timestamp,
+        output_frequency int,
+        rain_total numeric,
+        rain_duration int,
+        friction numeric,
+        green_areas_table text,
+        buildings_table text,
+        version_number text
+    );
+    """).format(run_table=sql.Identifier(run_table))
 
 
 @dataclass
@@ -41,6 +163,8 @@ class Run:
         metadata_table: Postgres table containing metadata
         version_number: Version of citycatpg used to create the model
         model: Citycatio Model object
+        srid: EPSG code of the DEM, kept once the model has been released
+        metrics: Durations, row counts and byte counts of each phase of retrieving, writing and executing the model
     """
     run_duration: int
 
@@ -72,6 +196,10 @@ class Run:
 
     model: Optional[Model] = None
 
+    srid: Optional[int] = field(default=None, init=False, repr=False, compare=False)
+    metrics: Metrics = field(default_factory=Metrics, init=False, repr=False, compare=False)
+    _loader: Optional[Callable[[], None]] = field(default=None, init=False, repr=False, compare=False)
+
     def add(self, con: connection):
         """Insert the configuration into the run_table
 
@@ -80,116 +208,153 @@ class Run:
         """
 
         query = sql.SQL("""
-        CREATE TABLE IF NOT EXISTS {run_table} (
-            run_id uuid PRIMARY KEY,
-            run_duration int, 
-            run_name text, 
-            domain_table text,
-            domain_id int,
-            dem_table text,
-            rain_table text,
-            rain_start timestamp,
-            rain_end timestamp,
-            output_frequency int,
-            rain_total numeric,
-            rain_duration int,
-            friction numeric,
-            green_areas_table text,
-            buildings_table text,
-            version_number text
-        );
-        
-        INSERT INTO {run_table} (
-            run_id,
-            run_duration, 
-            run_name, 
-            domain_table,
-            domain_id,
-            dem_table,
-            rain_table,
-            rain_start,
-            rain_end,
-            output_frequency,
-            rain_total,
-            rain_duration,
-            friction,
-            green_areas_table,
-            buildings_table,
-            version_number
-        ) 
-        VALUES (
-            %(run_id)s,
-            %(run_duration)s, 
-            %(run_name)s, 
-            %(domain_table)s,
-            %(domain_id)s,
-            %(dem_table)s,
-            %(rain_table)s,
-            %(rain_start)s,
-            %(rain_end)s,
-            %(output_frequency)s,
-            %(rain_total)s,
-            %(rain_duration)s,
-            %(friction)s,
-            %(green_areas_table)s,
-            %(buildings_table)s,
-            %(version_number)s
-        )
-        """).format(run_table=sql.Identifier(self.run_table))
+        {create_table}
+
+        INSERT INTO {run_table} ({columns})
+        VALUES ({values})
+        """).format(
+            create_table=_create_table(self.run_table),
+            run_table=sql.Identifier(self.run_table),
+            columns=sql.SQL(', ').join(map(sql.Identifier, _columns)),
+            values=sql.SQL(', ').join(map(sql.Placeholder, _columns)))
         with con:
             with con.cursor() as cur:
                 cur.execute(query, self.__dict__)
 
-    def get_model(self, con: connection, open_boundaries: bool = True):
-        """Create Model using data from postgres
+    def save_metrics(self, con: connection, metrics_table: str = 'run_metrics'):
+        """Update the run start and end times in the run_table and insert the recorded phases into the metrics_table
 
         Args:
             con: Postgres connection
+            metrics_table: Postgres table where the metrics are stored
+        """
+        with con:
+            with con.cursor() as cur:
+                cur.execute(sql.SQL("""
+                UPDATE {run_table} SET run_start = %(run_start)s, run_end = %(run_end)s WHERE run_id = %(run_id)s
+                """).format(run_table=sql.Identifier(self.run_table)), self.__dict__)
+        self.metrics.save(con, self.run_id, metrics_table)
+
+    def get_model(self, con: Optional[Union[connection, Session]], open_boundaries: bool = True,
+                  pool: Optional[Union[AbstractConnectionPool, str]] = None, cache: Optional[DomainCache] = None,
+                  tiled_dem: bool = False, clip_features: bool = False, simplify_features: bool = False,
+                  lazy: bool = False):
+        """Create Model using data from postgres
+
+        Args:
+            con: Postgres connection or Session, not used if pool is given.
+                A Session is used as the pool if no pool is given
             open_boundaries: Whether to treat domain boundaries as open
+            pool: Thread-safe connection pool or DSN used to retrieve the inputs concurrently,
+                each input is retrieved using its own connection
+            cache: Cache used to share the DEM, domain, buildings and green areas between runs
+            tiled_dem: Whether to stream the DEM tiles and mosaic them locally, see get_dem
+            clip_features: Whether to clip the buildings and green areas to the domain in postgres, see get_buildings
+            simplify_features: Whether to simplify the buildings and green areas to the DEM resolution in postgres
+            lazy: Whether to wait until the model is first needed by write before retrieving the inputs,
+                so that runs reused from a ResultCache are never retrieved. con or pool must remain open until then
 
         Returns:
             citycatio.Model: Citycatio Model object
         """
 
         assert self.rain_table is not None or self.rain_total is not None
-        rainfall, rainfall_polygons = self.get_rainfall(con)
 
-        if open_boundaries:
-            open_boundaries = gpd.GeoDataFrame(geometry=self.get_domain(con).buffer(1000))
-        else:
-            open_boundaries = None
+        if pool is None and isinstance(con, Session):
+            pool = con
+        getters = self._getters(open_boundaries, cache, tiled_dem,
+                                clip_features=clip_features, simplify_features=simplify_features)
+        self.model = None
+        self._loader = lambda: self._build_model(_get_inputs(con, getters, pool), open_boundaries)
+        if not lazy:
+            self._require_model()
+
+    def _require_model(self) -> Model:
+        if self.model is None and self._loader is not None:
+            self._loader()
+        assert self.model is not None, 'Please generate a Model object using get_model'
+        return self.model
 
-        if self.buildings_table is not None:
-            buildings = self.get_buildings(con)
-        else:
-            buildings = None
+    def release(self):
+        """Drop the model so that the memory used by its inputs can be freed once it has been written
 
+        The EPSG code of the DEM is kept for converting the outputs.
+        If get_model has been called, the inputs are retrieved again if the model is needed later
+        """
+        if self.model is not None:
+            self._srid()
+        self.model = None
+
+    def _getters(self, open_boundaries: bool, cache: Optional[DomainCache], tiled_dem: bool,
+                 rainfall: Optional[Callable] = None, clip_features: bool = False,
+                 simplify_features: bool = False) -> Dict[str, Callable]:
+        getters = dict(dem=functools.partial(self.get_dem, tiled=tiled_dem),
+                       rainfall=rainfall if rainfall is not None else self.get_rainfall)
+        if open_boundaries:
+            getters['domain'] = self.get_domain
+        if self.buildings_table is not None:
+            getters['buildings'] = functools.partial(self.get_buildings, clip=clip_features,
+                                                     simplify=simplify_features)
         if self.green_areas_table is not None:
-            green_areas = self.get_green_areas(con)
+            getters['green_areas'] = functools.partial(self.get_green_areas, clip=clip_features,
+                                                       simplify=simplify_features)
+
+        if cache is not None:
+            tables = dict(dem=self.dem_table, domain=self.domain_table, buildings=self.buildings_table,
+                          green_areas=self.green_areas_table)
+            # Clipped and simplified features are cached separately from the full polygons
+            variant = ('_clipped' if clip_features else '') + ('_simplified' if simplify_features else '')
+            keys = dict(buildings=f'buildings{variant}', green_areas=f'green_areas{variant}')
+            getters = {name: self._cached(cache, keys.get(name, name), tables[name], getter) if name in tables
+                       else getter for name, getter in getters.items()}
+        return {name: self._timed(name, getter) for name, getter in getters.items()}
+
+    def _build_model(self, inputs: dict, open_boundaries: bool):
+        rainfall, rainfall_polygons = inputs['rainfall']
+
+        if open_boundaries:
+            open_boundaries = gpd.GeoDataFrame(geometry=inputs['domain'].buffer(1000))
         else:
-            green_areas = None
+            open_boundaries = None
 
         self.model = Model(
-            dem=self.get_dem(con),
+            dem=inputs['dem'],
             rainfall=rainfall,
             rainfall_polygons=rainfall_polygons,
             duration=self.run_duration,
             output_interval=self.output_frequency,
             open_boundaries=open_boundaries,
-            buildings=buildings,
-            green_areas=green_areas
+            buildings=inputs.get('buildings'),
+            green_areas=inputs.get('green_areas')
         )
 
-    def get_dem(self, con: connection):
+    def _cached(self, cache: DomainCache, name: str, table: str, getter: Callable):
+        key = (name, table, self.domain_table, self.domain_id)
+        return lambda con: cache.get(key, lambda: getter(con))
+
+    def _timed(self, name: str, getter: Callable):
+        def timed(con):
+            with self.metrics.phase(f'get_{name}') as record:
+                value = getter(con)
+                record.update(_counts(value))
+            return value
+        return timed
+
+    def get_dem(self, con: connection, tiled: bool = False):
         """Get DEM data from postgres
 
         Args:
             con: Postgres connection
+            tiled: Whether to stream the clipped tiles and mosaic them locally
+                instead of creating a single raster in postgres
 
         Returns:
             rasterio.io.MemoryFile: DEM file
         """
 
+        if tiled:
+            return self._get_dem_tiled(con)
+
         with con:
             with con.cursor() as cursor:
                 cursor.execute(sql.SQL("""
@@ -202,6 +367,34 @@ class Run:
 
                 return rio.MemoryFile(cursor.fetchone()[0].tobytes())
 
+    def _get_dem_tiled(self, con: connection, itersize: int = 16):
+        tables = dict(dem_table=sql.Identifier(self.dem_table), domain_table=sql.Identifier(self.domain_table))
+
+        with con:
+            with con.cursor() as cursor:
+                cursor.execute(sql.SQL("""
+                SELECT ST_ScaleX(rast), ST_ScaleY(rast),
+                    min(ST_UpperLeftX(rast)), max(ST_UpperLeftY(rast)),
+                    max(ST_UpperLeftX(rast) + ST_Width(rast) * ST_ScaleX(rast)),
+                    min(ST_UpperLeftY(rast) + ST_Height(rast) * ST_ScaleY(rast)),
+                    ST_XMin(geom), ST_YMin(geom), ST_XMax(geom), ST_YMax(geom)
+                FROM {dem_table}, {domain_table} WHERE ST_Intersects(rast, geom) and gid=%(domain_id)s
+                GROUP BY 1, 2, 7, 8, 9, 10
+                """).format(**tables), self.__dict__)
+                assert cursor.rowcount == 1, f'Tiles in {self.dem_table} must share the same resolution'
+                res_x, res_y, *tile_bounds, x_min, y_min, x_max, y_max = cursor.fetchone()
+
+            transform, width, height = _snap_to_grid(res_x, res_y, *tile_bounds, x_min, y_min, x_max, y_max)
+
+            with con.cursor(name=f'citycatpg_{uuid.uuid4().hex}') as cursor:
+                cursor.itersize = itersize
+                cursor.execute(sql.SQL("""
+                SELECT ST_AsGDALRaster(ST_Clip(rast, geom), 'GTiff')
+                FROM {dem_table}, {domain_table} WHERE ST_Intersects(rast, geom) and gid=%(domain_id)s
+                """).format(**tables), self.__dict__)
+
+                return _mosaic((tile for tile, in cursor), transform, width, height)
+
     def get_domain(self, con: connection):
         """Get domain boundary from postgres
 
@@ -212,12 +405,14 @@ class Run:
             geopandas.GeoDataFrame: Domain polygon
         """
 
-        return gpd.GeoDataFrame.from_postgis(sql.SQL("""
-        SELECT geom FROM {domain_table} WHERE gid={domain_id}
-        """).format(
-            domain_id=sql.Literal(self.domain_id),
-            domain_table=sql.Identifier(self.domain_table)
-        ).as_string(con), con=con)
+        with con.cursor() as cur:
+            _execute(cur, sql.SQL('SELECT geom, ST_SRID(geom) FROM {domain_table} WHERE gid=%(domain_id)s').format(
+                domain_table=sql.Identifier(self.domain_table)), dict(domain_id=self.domain_id))
+            rows = cur.fetchall()
+
+        srid = rows[0][1] if len(rows) > 0 else 0
+        return gpd.GeoDataFrame({'geom': gpd.GeoSeries([wkb.loads(g, hex=True) for g, _ in rows],
+                                                       crs=f'epsg:{srid}' if srid != 0 else None)}, geometry='geom')
 
     def get_rainfall(self, con: connection):
         """Get rainfall data from postgres
@@ -246,192 +441,540 @@ class Run:
             assert self.rain_start and self.rain_end, 'Rain start and end times are required if rain total is not given'
 
             with con.cursor() as cur:
-                cur.execute(
-                    sql.SQL('select start, frequency from {metadata_table} where dataset = %(dataset)s').format(
-                        metadata_table=sql.Identifier(self.metadata_table)),
+                _execute(
+                    cur,
+                    sql.SQL("""
+                    select start, frequency, (to_jsonb(metadata) ->> 'chunk_size')::int
+                    from {metadata_table} as metadata where dataset = %(dataset)s
+                    """).format(metadata_table=sql.Identifier(self.metadata_table)),
                     dict(dataset=self.rain_table)
                 )
                 assert cur.rowcount == 1, f'Metadata missing for {self.rain_table}'
-                start, frequency = cur.fetchone()
+                start, frequency, chunk_size = cur.fetchone()
+
+            if chunk_size is not None:
+                geoms, srids, series = self._get_rainfall_chunks(con, start, frequency, chunk_size)
+            else:
+                idx_min = ((self.rain_start-start) / frequency) + 1
+                idx_max = ((self.rain_end-start) / frequency) + 1
+
+                with con.cursor() as cur:
+                    cur.execute(sql.SQL("""
+                    SELECT {rain_table}.geom, ST_SRID({rain_table}.geom), series[{idx_min}:{idx_max}]::float8[]
+                    FROM {rain_table}, {domain_table}
+                    WHERE ST_Intersects({rain_table}.geom, {domain_table}.geom)
+                    AND {domain_table}.gid={domain_id}
+                    """).format(
+                        idx_min=sql.Literal(idx_min),
+                        idx_max=sql.Literal(idx_max),
+                        rain_table=sql.Identifier(self.rain_table),
+                        domain_table=sql.Identifier(self.domain_table),
+                        domain_id=sql.Literal(self.domain_id)
+                    ))
+                    rows = cur.fetchall()
+                    assert len(rows) > 0, f'No rainfall in {self.rain_table} intersects the domain'
+                    geoms, srids, series = zip(*rows)
+                    series = np.array(series, dtype=float)
+
+            geom = gpd.GeoSeries([wkb.loads(g, hex=True) for g in geoms], name='geom',
+                                 crs=f'epsg:{srids[0]}' if srids[0] != 0 else None)
+            rain = pd.DataFrame(series.T / frequency.total_seconds() / 1000,
+                                columns=pd.Index(range(len(geom)), name='columns'))
+            rain.index = pd.date_range(start=self.rain_start, freq=frequency, periods=len(rain))
+            rain.index = (rain.index - rain.index[0]).total_seconds().astype(int)
+
+            return rain, geom
 
-            idx_min = ((self.rain_start-start) / frequency) + 1
-            idx_max = ((self.rain_end-start) / frequency) + 1
+    def _get_rainfall_chunks(self, con: connection, start: datetime, frequency: timedelta, chunk_size: int):
+        idx_min = (self.rain_start - start) // frequency
+        idx_max = (self.rain_end - start) // frequency
+        chunk_min, chunk_max = idx_min // chunk_size, idx_max // chunk_size
 
-            rain = gpd.GeoDataFrame.from_postgis(sql.SQL("""
-            SELECT {rain_table}.geom, series[{idx_min}:{idx_max}]
-            FROM {rain_table}, {domain_table}
+        with con.cursor() as cur:
+            cur.execute(sql.SQL("""
+            SELECT {rain_table}.geom, ST_SRID({rain_table}.geom), string_agg(data, ''::bytea ORDER BY chunk)
+            FROM {rain_table}
+            JOIN {chunks_table} ON {chunks_table}.gid = {rain_table}.gid, {domain_table}
             WHERE ST_Intersects({rain_table}.geom, {domain_table}.geom)
-            AND {domain_table}.gid={domain_id}
+            AND {domain_table}.gid = %(domain_id)s
+            AND chunk BETWEEN %(chunk_min)s AND %(chunk_max)s
+            GROUP BY {rain_table}.gid, {rain_table}.geom
+            ORDER BY {rain_table}.gid
             """).format(
-                idx_min=sql.Literal(idx_min),
-                idx_max=sql.Literal(idx_max),
                 rain_table=sql.Identifier(self.rain_table),
-                rain_start=sql.Literal(self.rain_start),
-                rain_end=sql.Literal(self.rain_end),
-                domain_table=sql.Identifier(self.domain_table),
-                domain_id=sql.Literal(self.domain_id)
-            ).as_string(con), con)
-            geom = rain.geom
-            rain = rain.series.explode()
-            rain = pd.DataFrame({'values': rain.values, 'index': list(range(len(rain[0]))) * len(geom),
-                                'columns': rain.index}).pivot(values='values', index='index', columns='columns')
-            rain = rain.astype(float) / frequency.total_seconds() / 1000
-            rain.index = pd.date_range(start=self.rain_start, freq=frequency, periods=len(rain))
-            rain.index = (rain.index - rain.index[0]).total_seconds().astype(int)
-
-            return rain if type(rain) == pd.DataFrame else rain.to_frame(), geom
-
-    def get_buildings(self, con: connection):
+                chunks_table=sql.Identifier(f'{self.rain_table}_chunks'),
+                domain_table=sql.Identifier(self.domain_table)),
+                dict(domain_id=self.domain_id, chunk_min=chunk_min, chunk_max=chunk_max))
+            rows = cur.fetchall()
+            assert len(rows) > 0, f'No rainfall in {self.rain_table} intersects the domain'
+            geoms, srids, chunks = zip(*rows)
+
+        offset = idx_min - chunk_min * chunk_size
+        series = np.frombuffer(b''.join(chunks), dtype='<f4').reshape(len(chunks), -1)
+        series = series[:, offset:offset + idx_max - idx_min + 1].astype(float)
+        return geoms, srids, series[:, :np.flatnonzero(~np.isnan(series).all(axis=0)).max(initial=-1) + 1]
+
+    def get_buildings(self, con: connection, clip: bool = False, simplify: bool = False):
         """Get buildings from postgres
 
         Args:
             con: Postgres connection
+            clip: Whether to clip the buildings to the domain in postgres, see _get_features
+            simplify: Whether to simplify the buildings to the DEM resolution in postgres, see _get_features
 
         Returns:
             geopandas.GeoDataFrame: Buildings polygons
         """
 
-        return gpd.GeoDataFrame.from_postgis(sql.SQL("""
-        SELECT {buildings_table}.geom 
-        FROM {buildings_table}, {domain_table} 
-        WHERE ST_Intersects({buildings_table}.geom, {domain_table}.geom) 
-        AND {domain_table}.gid={domain_id}
-        """).format(
-            domain_id=sql.Literal(self.domain_id),
-            buildings_table=sql.Identifier(self.buildings_table),
-            domain_table=sql.Identifier(self.domain_table),
-        ).as_string(con), con=con)
+        return self._get_features(con, self.buildings_table, clip, simplify)
 
-    def get_green_areas(self, con: connection):
+    def get_green_areas(self, con: connection, clip: bool = False, simplify: bool = False):
         """Get green areas from postgres
 
         Args:
             con: Postgres connection
+            clip: Whether to clip the green areas to the domain in postgres, see _get_features
+            simplify: Whether to simplify the green areas to the DEM resolution in postgres, see _get_features
 
         Returns:
-            geopandas.GeoDataFrame: Buildings polygons
+            geopandas.GeoDataFrame: Green areas polygons
         """
 
-        return gpd.GeoDataFrame.from_postgis(sql.SQL("""
-        SELECT {green_areas_table}.geom 
-        FROM {green_areas_table}, {domain_table} 
-        WHERE ST_Intersects({green_areas_table}.geom, {domain_table}.geom) 
-        AND {domain_table}.gid={domain_id}
-        """).format(
-            domain_id=sql.Literal(self.domain_id),
-            green_areas_table=sql.Identifier(self.green_areas_table),
-            domain_table=sql.Identifier(self.domain_table),
-        ).as_string(con), con=con)
+        return self._get_features(con, self.green_areas_table, clip, simplify)
 
-    def execute(self, run_path: str, out_path: str):
-        """Execute model using current configuration
+    def _get_features(self, con: connection, table: str, clip: bool, simplify: bool) -> gpd.GeoDataFrame:
+        """Get the polygons of a table that intersect the domain
+
+        Polygons are read using GeoDataFrame.from_postgis unless they are clipped or simplified,
+        in which case they are processed in postgres and transferred as WKB
 
-        Model attribute must be present
+        Args:
+            con: Postgres connection
+            table: Postgres table containing the polygons
+            clip: Whether to clip polygons that cross the domain boundary using ST_Intersection,
+                multi-part results are split into polygons
+            simplify: Whether to simplify the polygons using the resolution of the DEM as the tolerance
+
+        Returns:
+            geopandas.GeoDataFrame: Polygons in a geom column
+        """
+        tables = dict(table=sql.Identifier(table), domain_table=sql.Identifier(self.domain_table),
+                      dem_table=sql.Identifier(self.dem_table))
+        if not clip and not simplify:
+            return gpd.GeoDataFrame.from_postgis(sql.SQL("""
+            SELECT {table}.geom
+            FROM {table}, {domain_table}
+            WHERE ST_Intersects({table}.geom, {domain_table}.geom)
+            AND {domain_table}.gid={domain_id}
+            """).format(domain_id=sql.Literal(self.domain_id), **tables).as_string(con), con=con)
+
+        geom = sql.SQL('{table}.geom').format(**tables)
+        if clip:
+            geom = sql.SQL("""
+            CASE WHEN ST_CoveredBy({geom}, {domain_table}.geom) THEN {geom}
+            ELSE ST_CollectionExtract(ST_Intersection({geom}, {domain_table}.geom), 3) END
+            """).format(geom=geom, **tables)
+        if simplify:
+            geom = sql.SQL("""
+            ST_SimplifyPreserveTopology({geom}, (SELECT abs(ST_ScaleX(rast)) FROM {dem_table} LIMIT 1))
+            """).format(geom=geom, **tables)
+
+        with con.cursor() as cur:
+            _execute(cur, sql.SQL("""
+            SELECT ST_AsBinary({output}), ST_SRID({output}) FROM (
+                SELECT {geom} AS geom
+                FROM {table}, {domain_table}
+                WHERE ST_Intersects({table}.geom, {domain_table}.geom) AND {domain_table}.gid=%(domain_id)s
+            ) AS features{dump}
+            """).format(
+                geom=geom,
+                output=sql.SQL('parts.geom' if clip else 'features.geom'),
+                dump=sql.SQL(', ST_Dump(features.geom) AS parts WHERE NOT ST_IsEmpty(parts.geom)' if clip else ''),
+                **tables), dict(domain_id=self.domain_id))
+            rows = cur.fetchall()
+
+        srid = rows[0][1] if len(rows) > 0 else 0
+        geoms = [wkb.loads(bytes(g)) for g, _ in rows]
+        return gpd.GeoDataFrame({'geom': gpd.GeoSeries(geoms, crs=f'epsg:{srid}' if srid != 0 else None)},
+                                geometry='geom')
+
+    def write(self, run_path: str, store: Optional[InputStore] = None, release: bool = False) -> str:
+        """Create the model directory and copy the CityCAT executable into it
+
+        Model attribute must be present, or get_model must have been called with lazy=True
 
         Args:
             run_path: Directory in which to create the model directory
-            out_path: Directory in which to create the output netCDF and GeoTIFF files
+            store: Content-addressed store used to link input files and the executable rather than writing them
+            release: Whether to release the model once it has been written, see release
+
+        Returns:
+            str: Path to the model directory
         """
-        assert self.model is not None, 'Please generate a Model object using get_model'
+        model = self._require_model()
         if not os.path.exists(run_path):
             os.mkdir(run_path)
-        run_path = os.path.join(run_path, f'{self.run_name}-{self.run_id}')
-        self.model.write(run_path)
+        model_path = os.path.join(run_path, f'{self.run_name}-{self.run_id}')
+        with self.metrics.phase('write') as record:
+            if store is not None:
+                store.write_model(model, model_path)
+            else:
+                model.write(model_path)
+            record['bytes'] = _directory_size(model_path)
+        if release:
+            self.release()
 
         executable = os.getenv('CITYCAT')
-        if executable is None:
+        if executable is not None:
+            if store is not None:
+                store.link_executable(executable, model_path)
+            else:
+                shutil.copy(executable, model_path)
+
+        return model_path
+
+    def execute(self, run_path: str, out_path: str, written: bool = False, stream: bool = False,
+                delete: bool = False, store: Optional[InputStore] = None, results: Optional[ResultCache] = None):
+        """Execute model using current configuration
+
+        Model attribute must be present unless written is True. The model is released once it has been written
+
+        Args:
+            run_path: Directory in which to create the model directory
+            out_path: Directory in which to create the output netCDF and GeoTIFF files
+            written: Whether the model directory has already been created using write
+            stream: Whether to append results to the netCDF file while the model is running, see execute_async
+            delete: Whether to delete each results file once it has been appended to the netCDF file
+            store: Content-addressed store used to link input files and the executable rather than writing them
+            results: Cache used to reuse the outputs of a run with the same configuration instead of executing CityCAT
+        """
+        if stream:
+            return asyncio.run(self.execute_async(run_path, out_path, written=written, stream=True, delete=delete,
+                                                  store=store, results=results))
+
+        key = results.key(self) if results is not None else None
+        if key is not None and self._reuse(results.get(key), out_path):
+            return
+        if written:
+            run_path = os.path.join(run_path, f'{self.run_name}-{self.run_id}')
+        else:
+            run_path = self.write(run_path, store, release=True)
+
+        if os.getenv('CITYCAT') is None:
             warnings.warn('CITYCAT environment variable missing')
             return
-        shutil.copy(executable, run_path)
-        self.run_start = datetime.now()
-        subprocess.call(f'cd {run_path} & citycat.exe -r 1 -c 1', shell=True)
-        self.run_end = datetime.now()
+        with self.metrics.phase('solver'):
+            self.run_start = datetime.now()
+            subprocess.call(f'cd {run_path} & citycat.exe -r 1 -c 1', shell=True)
+            self.run_end = datetime.now()
+
+        self._convert(run_path, out_path)
+        if key is not None:
+            results.add(key, self, *self._output_paths(out_path))
+
+    async def execute_async(self, run_path: str, out_path: str, written: bool = False,
+                            timeout: Optional[float] = None, progress: Optional[Callable[['Run', float], None]] = None,
+                            poll_interval: float = 1, stream: bool = False, delete: bool = False,
+                            store: Optional[InputStore] = None, results: Optional[ResultCache] = None):
+        """Execute model as a managed subprocess without blocking the event loop
+
+        Model attribute must be present unless written is True, the model is released once it has been written.
+        Writing the model and querying the results cache run in the default executor.
+        The CityCAT process is killed if the timeout is reached or the task is
+        cancelled, in which case asyncio.TimeoutError or asyncio.CancelledError is raised
+
+        Args:
+            run_path: Directory in which to create the model directory
+            out_path: Directory in which to create the output netCDF and GeoTIFF files
+            written: Whether the model directory has already been created using write
+            timeout: Maximum number of seconds to run CityCAT for
+            progress: Function called with the run and the fraction of output files created so far
+            poll_interval: Number of seconds between checking for new output files
+            stream: Whether to append results to a chunked netCDF file as they are written,
+                rather than converting all the results once the model has finished
+            delete: Whether to delete each results file once it has been appended to the netCDF file
+            store: Content-addressed store used to link input files and the executable rather than writing them
+            results: Cache used to reuse the outputs of a run with the same configuration instead of executing CityCAT
+        """
+        loop = asyncio.get_running_loop()
+        key = await loop.run_in_executor(None, results.key, self) if results is not None else None
+        if key is not None and await loop.run_in_executor(None, lambda: self._reuse(results.get(key), out_path)):
+            return
+        if written:
+            run_path = os.path.join(run_path, f'{self.run_name}-{self.run_id}')
+        else:
+            run_path = await loop.run_in_executor(None, functools.partial(self.write, run_path, store, release=True))
 
-        to_netcdf(
-            in_path=os.path.join(run_path, 'R1C1_SurfaceMaps'),
-            out_path=os.path.join(out_path, f'{self.run_name}-{self.run_id}.nc'),
-            start_time=self.rain_start if self.rain_start is not None else datetime(1, 1, 1),
-            attributes={
-                param: value if type(value) in [float, int] else str(value)
-                for param, value in self.__dict__.items() if param != 'model'},
-            srid=self.model.dem.data.open().crs.to_epsg())
+        executable = os.getenv('CITYCAT')
+        if executable is None:
+            warnings.warn('CITYCAT environment variable missing')
+            return
 
-        to_geotiff(os.path.join(run_path, 'R1C1_SurfaceMaps', 'R1_C1_max_depth.csv'),
-                   out_path=os.path.join(out_path, f'{self.run_name}-{self.run_id}.tif'))
+        surface_maps = os.path.join(run_path, 'R1C1_SurfaceMaps')
+        netcdf_stream = NetCDFStream(
+            surface_maps, os.path.join(out_path, f'{self.run_name}-{self.run_id}.nc'), start_time=self._start_time,
+            srid=self._srid(), delete=delete) if stream else None
+
+        async def monitor():
+            expected = max(self.run_duration // self.output_frequency, 1)
+            count = 0
+            while True:
+                await asyncio.sleep(poll_interval)
+                if netcdf_stream is not None:
+                    await loop.run_in_executor(None, netcdf_stream.update)
+                if progress is None or not os.path.exists(surface_maps):
+                    continue
+                current = len([file for file in os.listdir(surface_maps) if file.lower().endswith('.rsl')])
+                if netcdf_stream is not None and delete:
+                    current += len(netcdf_stream.steps)
+                if current != count:
+                    count = current
+                    progress(self, min(count / expected, 1))
+
+        with self.metrics.phase('solver'):
+            self.run_start = datetime.now()
+            process = await asyncio.create_subprocess_exec(
+                os.path.join(os.path.abspath(run_path), os.path.basename(executable)), '-r', '1', '-c', '1',
+                cwd=run_path)
+            monitor_task = asyncio.create_task(monitor()) if progress is not None or stream else None
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                process.kill()
+                await process.wait()
+                if netcdf_stream is not None:
+                    netcdf_stream.close()
+                raise
+            finally:
+                if monitor_task is not None:
+                    monitor_task.cancel()
+            self.run_end = datetime.now()
+
+        if netcdf_stream is None:
+            await loop.run_in_executor(None, self._convert, run_path, out_path)
+        else:
+            def finish_netcdf():
+                with self.metrics.phase('netcdf') as record:
+                    netcdf_stream.update(final=True)
+                    netcdf_stream.attributes = self._attributes()
+                    netcdf_stream.close()
+                    record['rows'] = len(netcdf_stream.steps)
+
+            await asyncio.gather(
+                loop.run_in_executor(None, finish_netcdf),
+                loop.run_in_executor(None, self._to_geotiff, run_path, out_path))
+
+        if key is not None:
+            await loop.run_in_executor(None, lambda: results.add(key, self, *self._output_paths(out_path)))
+
+    def _output_paths(self, out_path: str) -> Tuple[str, str]:
+        return tuple(os.path.join(out_path, f'{self.run_name}-{self.run_id}.{extension}')
+                     for extension in ['nc', 'tif'])
+
+    def _reuse(self, outputs: Optional[Tuple[str, str]], out_path: str) -> bool:
+        if outputs is None:
+            return False
+        if not os.path.exists(out_path):
+            os.mkdir(out_path)
+        for source, destination in zip(outputs, self._output_paths(out_path)):
+            if os.path.exists(destination):
+                if os.path.samefile(source, destination):
+                    continue
+                os.remove(destination)
+            try:
+                os.link(source, destination)
+            except OSError:
+                shutil.copy(source, destination)
+        return True
+
+    @property
+    def _start_time(self) -> datetime:
+        return self.rain_start if self.rain_start is not None else datetime(1, 1, 1)
+
+    def _attributes(self) -> dict:
+        return {param: value if type(value) in [float, int] else str(value)
+                for param, value in self.__dict__.items() if param not in ['model', 'srid', 'metrics', '_loader']}
+
+    def _srid(self) -> int:
+        if self.srid is None:
+            with self._require_model().dem.data.open() as dem:
+                self.srid = dem.crs.to_epsg()
+        return self.srid
+
+    def _convert(self, run_path: str, out_path: str):
+        with self.metrics.phase('netcdf') as record:
+            file_path = os.path.join(out_path, f'{self.run_name}-{self.run_id}.nc')
+            to_netcdf(
+                in_path=os.path.join(run_path, 'R1C1_SurfaceMaps'),
+                out_path=file_path,
+                start_time=self._start_time,
+                attributes=self._attributes(),
+                srid=self._srid())
+            record['bytes'] = os.path.getsize(file_path)
+
+        self._to_geotiff(run_path, out_path)
+
+    def _to_geotiff(self, run_path: str, out_path: str):
+        with self.metrics.phase('geotiff') as record:
+            file_path = os.path.join(out_path, f'{self.run_name}-{self.run_id}.tif')
+            to_geotiff(os.path.join(run_path, 'R1C1_SurfaceMaps', 'R1_C1_max_depth.csv'), out_path=file_path)
+            record['bytes'] = os.path.getsize(file_path)
+
+
+def _from_row(row: tuple, run_table: str) -> Run:
+    run = dict(zip(_columns, row))
+    run['rain_total'] = float(run['rain_total']) if run['rain_total'] is not None else None
+    run['rain_duration'] = int(run['rain_duration']) if run['rain_duration'] is not None else None
+    run['friction'] = float(run['friction'])
+    return Run(run_table=run_table, **run)
+
+
+def _select(run_table: str, where: sql.Composable):
+    return sql.SQL("""
+    SELECT {columns}
+    FROM {run_table}
+    WHERE {where}
+    """).format(
+        columns=sql.SQL(', ').join(map(sql.Identifier, _columns)),
+        run_table=sql.Identifier(run_table),
+        where=where)
 
 
-def fetch(con: connection, run_id: str, run_table: str = 'runs'):
+def fetch(con: Union[connection, Session], run_id: str, run_table: str = 'runs'):
     """Get a run configuration from postgres
 
     Args:
-        con: Postgres connection
+        con: Postgres connection or Session
         run_id: Unique identifier for the run
         run_table: Postgres table where the run configuration is stored
 
     Returns:
         Run: Configuration used to create and run CityCAT models from postgres
     """
+    query = _select(run_table, sql.SQL('run_id = %(run_id)s'))
+    with _checkout(con) as con:
+        with con:
+            with con.cursor() as cur:
+                _execute(cur, query, dict(run_id=run_id))
+                response = cur.fetchone()
+                assert response is not None, 'Run does not exist in database'
+
+    return _from_row(response, run_table)
+
+
+def _iter_runs(con: Union[connection, Session], query: sql.Composable, params: dict, run_table: str, itersize: int):
+    with _checkout(con) as con:
+        with con:
+            with con.cursor(name=f'citycatpg_{uuid.uuid4().hex}') as cur:
+                cur.itersize = itersize
+                cur.execute(query, params)
+                for row in cur:
+                    yield _from_row(row, run_table)
+
+
+def fetch_many(con: Union[connection, Session], run_ids: Iterable[str], run_table: str = 'runs',
+               itersize: int = 1000) -> Iterator[Run]:
+    """Get multiple run configurations from postgres using a single query
+
+    Runs are read through a server-side cursor and yielded lazily in no particular order,
+    identifiers missing from the run_table are skipped
+
+    Args:
+        con: Postgres connection or Session
+        run_ids: Unique identifiers of the runs
+        run_table: Postgres table where the run configurations are stored
+        itersize: Number of rows to transfer from the server at a time
+
+    Returns:
+        Iterator[Run]: Configurations used to create and run CityCAT models from postgres
+    """
+    query = _select(run_table, sql.SQL('run_id = ANY(%(run_ids)s::uuid[])'))
+    return _iter_runs(con, query, dict(run_ids=list(run_ids)), run_table, itersize)
+
+
+def iter_runs(con: Union[connection, Session], filters: Optional[dict] = None, run_table: str = 'runs',
+              itersize: int = 1000) -> Iterator[Run]:
+    """Iterate over the run configurations in postgres that match the filters
+
+    Runs are read through a server-side cursor and yielded lazily
+
+    Args:
+        con: Postgres connection or Session
+        filters: Column names and the values they must be equal to, all runs are returned if not given
+        run_table: Postgres table where the run configurations are stored
+        itersize: Number of rows to transfer from the server at a time
+
+    Returns:
+        Iterator[Run]: Configurations used to create and run CityCAT models from postgres
+    """
+    filters = filters if filters is not None else {}
+    for column in filters:
+        assert column in _columns, f'{column} is not a column of {run_table}'
+
+    where = sql.SQL(' AND ').join(
+        sql.SQL('{} = {}').format(sql.Identifier(column), sql.Placeholder(column)) for column in filters
+    ) if filters else sql.SQL('true')
+
+    return _iter_runs(con, _select(run_table, where), filters, run_table, itersize)
+
+
+def add_many(con: connection, runs: Iterable[Run], run_table: str = 'runs', page_size: int = 1000) -> List[str]:
+    """Insert multiple run configurations into the run_table in a single transaction
+
+    The run_table is created once and the configurations are sent using multi-row inserts
+
+    Args:
+        con: Postgres connection
+        runs: Configurations to insert
+        run_table: Postgres table where the run configurations are stored
+        page_size: Maximum number of runs to include in each INSERT statement
+
+    Returns:
+        List[str]: Unique identifiers of the inserted runs
+    """
     query = sql.SQL("""
-    SELECT 
-        run_id,
-        run_duration, 
-        run_name, 
-        domain_table,
-        domain_id,
-        dem_table,
-        rain_table,
-        rain_start,
-        rain_end,
-        output_frequency,
-        rain_total,
-        rain_duration,
-        friction,
-        green_areas_table,
-        buildings_table,
-        version_number
-    
-    FROM {run_table}
-    WHERE run_id = %(run_id)s
-    """).format(run_table=sql.Identifier(run_table))
+    INSERT INTO {run_table} ({columns})
+    VALUES %s
+    RETURNING run_id
+    """).format(
+        run_table=sql.Identifier(run_table),
+        columns=sql.SQL(', ').join(map(sql.Identifier, _columns)))
+
     with con:
         with con.cursor() as cur:
-            cur.execute(query, dict(run_id=run_id))
-            response = cur.fetchone()
-            assert response is not None, 'Run does not exist in database'
-            (
-                run_id,
-                run_duration,
-                run_name,
-                domain_table,
-                domain_id,
-                dem_table,
-                rain_table,
-                rain_start,
-                rain_end,
-                output_frequency,
-                rain_total,
-                rain_duration,
-                friction,
-                green_areas_table,
-                buildings_table,
-                version_number
-            ) = response
-
-    return Run(
-        run_id=run_id,
-        run_duration=run_duration,
-        run_name=run_name,
-        domain_table=domain_table,
-        domain_id=domain_id,
-        dem_table=dem_table,
-        rain_table=rain_table,
-        rain_start=rain_start,
-        rain_end=rain_end,
-        output_frequency=output_frequency,
-        rain_total=float(rain_total) if rain_total is not None else None,
-        rain_duration=int(rain_duration) if rain_duration is not None else None,
-        friction=float(friction),
-        green_areas_table=green_areas_table,
-        buildings_table=buildings_table,
-        version_number=version_number
-    )
+            template = sql.SQL('({})').format(sql.SQL(', ').join(map(sql.Placeholder, _columns))).as_string(cur)
+            cur.execute(_create_table(run_table))
+            response = execute_values(cur, query.as_string(cur), (run.__dict__ for run in runs),
+                                      template=template, page_size=page_size, fetch=True)
+
+    return [run_id for run_id, in response]
+
+
+async def execute_many(runs: Iterable[Run], run_path: str, out_path: str, concurrency: int = 1,
+                       timeout: Optional[float] = None, progress: Optional[Callable[[Run, float], None]] = None,
+                       written: bool = False, store: Optional[InputStore] = None,
+                       results: Optional[ResultCache] = None) -> list:
+    """Execute multiple models concurrently using Run.execute_async
+
+    Args:
+        runs: Configurations with the model attribute present
+        run_path: Directory in which to create the model directories
+        out_path: Directory in which to create the output netCDF and GeoTIFF files
+        concurrency: Maximum number of models to run at the same time
+        timeout: Maximum number of seconds to run each model for
+        progress: Function called with the run and the fraction of output files created so far
+        written: Whether the model directories have already been created using write
+        store: Content-addressed store used to link input files and the executable rather than writing them
+        results: Cache used to reuse the outputs of runs with the same configuration instead of executing CityCAT
+
+    Returns:
+        list: None for each run that completed or the exception that was raised
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def execute(run: Run):
+        async with semaphore:
+            await run.execute_async(run_path, out_path, written=written, timeout=timeout, progress=progress,
+                                    store=store, results=results)
+
+    return await asyncio.gather(*[execute(run) for run in runs], return_exceptions=True)
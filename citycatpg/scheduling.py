@@ -0,0 +1,164 @@
+from .run import Run, fetch_many
+from . import pgqueue, server
+from typing import Iterable, List, Optional, Dict, Tuple
+from psycopg2.extensions import connection
+from psycopg2 import sql
+import numpy as np
+
+
+class CostModel:
+    """Estimates the relative solver time of runs
+
+    The solver time is modelled as a linear combination of the number of DEM cells multiplied by the run duration,
+    the number of DEM cells multiplied by the number of output files and a constant.
+    Until fit is called the estimate is proportional to the number of cells multiplied by the run duration.
+
+    Args:
+        coefficients: Coefficient of each feature
+    """
+    def __init__(self, coefficients: Optional[Iterable[float]] = None):
+        self.coefficients = np.array(list(coefficients) if coefficients is not None else [1, 0, 0], dtype=float)
+        self._cells = {}
+
+    def cells(self, con: connection, run: Run) -> float:
+        """Get the number of DEM cells in the domain of a run
+
+        Args:
+            con: Postgres connection
+            run: Run configuration
+
+        Returns:
+            float: Area of the domain divided by the area of a DEM cell
+        """
+        key = (run.domain_table, run.domain_id, run.dem_table)
+        if key not in self._cells:
+            with con:
+                with con.cursor() as cur:
+                    cur.execute(sql.SQL("""
+                    SELECT ST_Area(geom) / (SELECT abs(ST_ScaleX(rast) * ST_ScaleY(rast)) FROM {dem_table} LIMIT 1)
+                    FROM {domain_table} WHERE gid = %(domain_id)s
+                    """).format(
+                        dem_table=sql.Identifier(run.dem_table),
+                        domain_table=sql.Identifier(run.domain_table)), dict(domain_id=run.domain_id))
+                    assert cur.rowcount == 1, f'Domain {run.domain_id} missing from {run.domain_table}'
+                    self._cells[key] = cur.fetchone()[0]
+        return self._cells[key]
+
+    def features(self, con: connection, runs: Iterable[Run]) -> np.ndarray:
+        """Get the features used to estimate the cost of each run
+
+        Args:
+            con: Postgres connection
+            runs: Run configurations
+
+        Returns:
+            numpy.ndarray: Array with a row for each run
+        """
+        rows = []
+        for run in runs:
+            cells = self.cells(con, run)
+            rows.append([cells * run.run_duration, cells * max(run.run_duration // run.output_frequency, 1), 1])
+        return np.array(rows, dtype=float).reshape(-1, 3)
+
+    def estimate(self, con: connection, runs: Iterable[Run]) -> List[float]:
+        """Estimate the solver time of each run
+
+        Args:
+            con: Postgres connection
+            runs: Run configurations
+
+        Returns:
+            List[float]: Estimated cost of each run, in seconds if the model has been fitted
+        """
+        return list(self.features(con, runs) @ self.coefficients)
+
+    def fit(self, con: connection, run_table: str = 'runs', metrics_table: str = 'run_metrics',
+            limit: int = 10000) -> 'CostModel':
+        """Fit the coefficients to the solver times of previous runs, see Run.save_metrics
+
+        Args:
+            con: Postgres connection
+            run_table: Postgres table where the run configurations are stored
+            metrics_table: Postgres table where the metrics are stored
+            limit: Maximum number of the most recent runs to use
+
+        Returns:
+            CostModel: The fitted model
+        """
+        with con:
+            with con.cursor() as cur:
+                cur.execute(sql.SQL("""
+                SELECT run_id::text, sum(seconds) FROM {metrics_table} WHERE phase = 'solver'
+                GROUP BY run_id ORDER BY max(start) DESC LIMIT %(limit)s
+                """).format(metrics_table=sql.Identifier(metrics_table)), dict(limit=limit))
+                seconds = dict(cur.fetchall())
+
+        runs = list(fetch_many(con, seconds.keys(), run_table))
+        if len(runs) == 0:
+            return self
+
+        coefficients, *_ = np.linalg.lstsq(self.features(con, runs), [seconds[run.run_id] for run in runs],
+                                           rcond=None)
+        coefficients = np.clip(coefficients, 0, None)
+        if coefficients[:2].any():
+            self.coefficients = coefficients
+        return self
+
+
+def longest_first(con: connection, runs: Iterable[Run], cost_model: Optional[CostModel] = None) -> List[Run]:
+    """Sort runs by decreasing estimated cost
+
+    Args:
+        con: Postgres connection
+        runs: Run configurations
+        cost_model: Model used to estimate the cost of each run, an unfitted model is used if not given
+
+    Returns:
+        List[Run]: Sorted run configurations
+    """
+    return [run for run, _ in _with_costs(con, runs, cost_model)]
+
+
+def _with_costs(con: connection, runs: Iterable[Run], cost_model: Optional[CostModel]) -> List[Tuple[Run, float]]:
+    runs = list(runs)
+    cost_model = cost_model if cost_model is not None else CostModel()
+    return sorted(zip(runs, cost_model.estimate(con, runs)), key=lambda item: item[1], reverse=True)
+
+
+def enqueue(con: connection, runs: Iterable[Run], cost_model: Optional[CostModel] = None,
+            run_table: str = 'runs') -> Dict[str, float]:
+    """Mark runs as pending using their estimated cost as the priority, so longer runs are claimed first
+
+    Args:
+        con: Postgres connection
+        runs: Run configurations that have been added to the run_table
+        cost_model: Model used to estimate the cost of each run, an unfitted model is used if not given
+        run_table: Postgres table where the run configurations are stored
+
+    Returns:
+        Dict[str, float]: Estimated cost of each run
+    """
+    costs = {run.run_id: cost for run, cost in _with_costs(con, runs, cost_model)}
+    pgqueue.enqueue(con, costs.keys(), run_table, costs.values())
+    return costs
+
+
+def publish(con: connection, runs: Iterable[Run], queue: str = 'runs', host: str = 'localhost', port: int = 5672,
+            cost_model: Optional[CostModel] = None, **params) -> List[str]:
+    """Publish runs to a queue in order of decreasing estimated cost
+
+    Args:
+        con: Postgres connection
+        runs: Run configurations that have been added to the runs table
+        queue: Name of AQMP queue
+        host: Hostname of AQMP server
+        port: Port of AQMP server
+        cost_model: Model used to estimate the cost of each run, an unfitted model is used if not given
+        **params: Pika connection parameters
+
+    Returns:
+        List[str]: Unique identifiers of the runs in the order they were published
+    """
+    run_ids = [run.run_id for run in longest_first(con, runs, cost_model)]
+    server.publish(run_ids, queue, host, port, **params)
+    return run_ids
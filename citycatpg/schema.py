@@ -0,0 +1,176 @@
+"""Create and verify the indexes, raster constraints and statistics used by the queries of Run
+
+Usage:
+    python -m citycatpg.schema --dsn "dbname=test user=postgres password=password host=localhost" \\
+        --buildings-table buildings --green-areas-table green_areas --rain-table rain --overviews 2 4
+"""
+from .run import Run
+from typing import Optional, List, Dict
+from psycopg2.extensions import connection, cursor
+from psycopg2 import sql
+import argparse
+import json
+import psycopg2
+
+
+def _exists(cur: cursor, table: str) -> bool:
+    cur.execute('SELECT to_regclass(%(table)s) IS NOT NULL', dict(table=sql.Identifier(table).as_string(cur)))
+    return cur.fetchone()[0]
+
+
+def _indexes(cur: cursor, table: str) -> List[str]:
+    cur.execute('SELECT indexdef FROM pg_indexes WHERE tablename = %(table)s', dict(table=table))
+    return [indexdef for indexdef, in cur.fetchall()]
+
+
+def _create_index(cur: cursor, table: str, column: str, gist: bool) -> Optional[str]:
+    expression = f'st_convexhull({column})' if column == 'rast' else column
+    for indexdef in _indexes(cur, table):
+        definition = indexdef.lower().replace('"', '')
+        if ('using gist' in definition) == gist and f'({expression})' in definition:
+            return None
+
+    index = f'{table}_{column}_idx'
+    cur.execute(sql.SQL('CREATE INDEX IF NOT EXISTS {index} ON {table} {method} ({expression})').format(
+        index=sql.Identifier(index),
+        table=sql.Identifier(table),
+        method=sql.SQL('USING gist' if gist else ''),
+        expression=sql.SQL('ST_ConvexHull(rast)') if column == 'rast' else sql.Identifier(column)))
+    return index
+
+
+def _explain(cur: cursor, query: sql.Composable, params: dict) -> float:
+    cur.execute(sql.SQL('EXPLAIN (FORMAT JSON) ') + query, params)
+    return cur.fetchone()[0][0]['Plan']['Total Cost']
+
+
+def _queries(run: Run) -> Dict[str, sql.Composable]:
+    tables = dict(domain_table=sql.Identifier(run.domain_table), dem_table=sql.Identifier(run.dem_table))
+    queries = dict(
+        dem=sql.SQL("""
+        SELECT ST_Clip(rast, geom) FROM {dem_table}, {domain_table}
+        WHERE ST_Intersects(rast, geom) and gid=%(domain_id)s
+        """).format(**tables),
+        domain=sql.SQL('SELECT geom FROM {domain_table} WHERE gid=%(domain_id)s').format(**tables))
+
+    for name, table in [('rain', run.rain_table), ('buildings', run.buildings_table),
+                        ('green_areas', run.green_areas_table)]:
+        if table is not None:
+            queries[name] = sql.SQL("""
+            SELECT {table}.geom FROM {table}, {domain_table}
+            WHERE ST_Intersects({table}.geom, {domain_table}.geom) AND {domain_table}.gid=%(domain_id)s
+            """).format(table=sql.Identifier(table), **tables)
+    if run.rain_table is not None:
+        queries['metadata'] = sql.SQL('SELECT start, frequency FROM {metadata_table} WHERE dataset = %(rain_table)s') \
+            .format(metadata_table=sql.Identifier(run.metadata_table))
+    return queries
+
+
+def optimise(con: connection, run: Run, overviews: Optional[List[int]] = None, retile: Optional[int] = None,
+             analyze: bool = True) -> dict:
+    """Create the indexes, raster constraints and statistics used when creating models from a run configuration
+
+    GiST indexes are created on the geometry of the domain, rain, buildings and green areas tables and on the convex
+    hull of the DEM tiles, and b-tree indexes are created on run_id and dataset in the run and metadata tables.
+    Existing equivalent indexes are kept. The srid, scale, blocksize and alignment raster constraints are added to
+    the DEM if it has none, so that its metadata is read from raster_columns.
+
+    Args:
+        con: Postgres connection
+        run: Configuration whose tables are optimised
+        overviews: Factors of DEM overviews to create using ST_CreateOverview
+        retile: Split DEM tiles larger than this number of cells along either side, replacing the dem_table
+        analyze: Whether to update the table statistics
+
+    Returns:
+        dict: Created indexes, raster constraints and overviews, and the estimated cost of each query
+            before and after optimising
+    """
+    report = dict(indexes=[], constraints=False, overviews=[], retiled=False, costs={})
+    queries = _queries(run)
+    columns = [(run.domain_table, 'geom', True), (run.dem_table, 'rast', True), (run.rain_table, 'geom', True),
+               (run.buildings_table, 'geom', True), (run.green_areas_table, 'geom', True),
+               (run.run_table, 'run_id', False), (run.metadata_table, 'dataset', False)]
+
+    with con:
+        with con.cursor() as cur:
+            columns = [(table, column, gist) for table, column, gist in columns
+                       if table is not None and _exists(cur, table)]
+            before = {name: _explain(cur, query, run.__dict__) for name, query in queries.items()}
+
+            if retile is not None:
+                cur.execute(sql.SQL('SELECT max(greatest(ST_Width(rast), ST_Height(rast))) FROM {dem_table}').format(
+                    dem_table=sql.Identifier(run.dem_table)))
+                if cur.fetchone()[0] > retile:
+                    cur.execute(sql.SQL("""
+                    CREATE TABLE {retiled} AS
+                    SELECT row_number() OVER () AS rid, rast
+                    FROM (SELECT ST_Tile(rast, %(size)s, %(size)s) AS rast FROM {dem_table}) AS tiles;
+                    DROP TABLE {dem_table};
+                    ALTER TABLE {retiled} RENAME TO {dem_table};
+                    ALTER TABLE {dem_table} ADD PRIMARY KEY (rid);
+                    """).format(
+                        retiled=sql.Identifier(f'{run.dem_table}_retiled'),
+                        dem_table=sql.Identifier(run.dem_table)), dict(size=retile))
+                    report['retiled'] = True
+
+            for table, column, gist in columns:
+                index = _create_index(cur, table, column, gist)
+                if index is not None:
+                    report['indexes'].append(index)
+
+            cur.execute('SELECT scale_x IS NOT NULL FROM raster_columns WHERE r_table_name = %(dem_table)s',
+                        run.__dict__)
+            row = cur.fetchone()
+            if row is not None and not row[0]:
+                # The extent constraint is not added so that tiles outside the current extent can still be loaded
+                cur.execute("""
+                SELECT AddRasterConstraints(
+                    %(dem_table)s::name, 'rast'::name, 'srid', 'scale', 'blocksize', 'alignment')
+                """, run.__dict__)
+                report['constraints'] = cur.fetchone()[0]
+
+            for factor in overviews or []:
+                overview = f'o_{factor}_{run.dem_table}'
+                if not _exists(cur, overview):
+                    cur.execute("SELECT ST_CreateOverview(%(dem_table)s::regclass, 'rast'::name, %(factor)s)",
+                                dict(dem_table=sql.Identifier(run.dem_table).as_string(cur), factor=factor))
+                    report['overviews'].append(cur.fetchone()[0])
+
+            if analyze:
+                for table, _, _ in columns:
+                    cur.execute(sql.SQL('ANALYZE {table}').format(table=sql.Identifier(table)))
+
+    with con:
+        with con.cursor() as cur:
+            after = {name: _explain(cur, query, run.__dict__) for name, query in queries.items()}
+    report['costs'] = {name: dict(before=before[name], after=after[name]) for name in queries}
+
+    return report
+
+
+def main():
+    defaults = Run(0)
+    parser = argparse.ArgumentParser(description='Create the indexes and statistics used by citycatpg')
+    parser.add_argument('--dsn', default='dbname=test user=postgres password=password host=localhost')
+    for field in ['run_table', 'domain_table', 'dem_table', 'rain_table', 'buildings_table', 'green_areas_table',
+                  'metadata_table']:
+        parser.add_argument(f'--{field.replace("_", "-")}', default=getattr(defaults, field))
+    parser.add_argument('--domain-id', type=int, default=defaults.domain_id)
+    parser.add_argument('--overviews', type=int, nargs='*')
+    parser.add_argument('--retile', type=int)
+    parser.add_argument('--no-analyze', action='store_true')
+    args = parser.parse_args()
+
+    run = Run(0, run_table=args.run_table, domain_table=args.domain_table, domain_id=args.domain_id,
+              dem_table=args.dem_table, rain_table=args.rain_table, buildings_table=args.buildings_table,
+              green_areas_table=args.green_areas_table, metadata_table=args.metadata_table)
+    con = psycopg2.connect(args.dsn)
+    try:
+        print(json.dumps(optimise(con, run, args.overviews, args.retile, not args.no_analyze), indent=2))
+    finally:
+        con.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,57 +1,263 @@
-from .run import fetch
-from datetime import datetime
+from .session import Session, _checkout
+from .metrics import Metrics, serve_metrics
+from . import pgqueue
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Optional, List, Union, Iterable
 import functools
+import os
+import socket
+import time
+import traceback
 import pika
 import threading
+import psycopg2
 import psycopg2.extensions
 
+_attempts_header = 'x-citycatpg-attempts'
+_worker_con = None
+_worker_store = None
+_worker_results = None
 
-def run_server(con: psycopg2.extensions.connection, run_path: str, out_path: str, queue: str = 'runs',
-               host: str = 'localhost', port: int = 5672, close: bool = False, **params):
+# Modules that import geopandas, rasterio and citycatio are imported when the first run is processed,
+# so that servers start listening without waiting for them
+
+
+def _input_store(store_path: Optional[str]):
+    if store_path is None:
+        return None
+    from .store import InputStore
+    return InputStore(store_path)
+
+
+def _result_cache(con: Union[psycopg2.extensions.connection, Session, None], results_table: Optional[str]):
+    if results_table is None:
+        return None
+    from .cache import ResultCache
+    return ResultCache(con, results_table)
+
+
+def _init_worker(dsn: str, store_path: Optional[str] = None, results_table: Optional[str] = None):
+    global _worker_con, _worker_store, _worker_results
+    _worker_con = psycopg2.connect(dsn)
+    _worker_store = _input_store(store_path)
+    _worker_results = _result_cache(_worker_con, results_table)
+
+
+def _process_run(run_id: str, run_path: str, out_path: str, run_table: str = 'runs',
+                 metrics_table: Optional[str] = None, load_results: bool = False) -> List[dict]:
+    from .run import fetch
+    from .results import write_results
+
+    run = fetch(_worker_con, run_id, run_table)
+    run.get_model(_worker_con, lazy=True)
+    run.execute(run_path, out_path, store=_worker_store, results=_worker_results)
+    if load_results:
+        write_results(_worker_con, run, out_path)
+    if metrics_table is not None:
+        run.save_metrics(_worker_con, metrics_table)
+    return run.metrics.phases
+
+
+def publish(run_ids: Iterable[str], queue: str = 'runs', host: str = 'localhost', port: int = 5672,
+            **params) -> int:
+    """Publish run identifiers to a queue for run_server using a single connection
+
+    Args:
+        run_ids: Unique identifiers of runs that have been added to the runs table
+        queue: Name of AQMP queue
+        host: Hostname of AQMP server
+        port: Port of AQMP server
+        **params: Pika connection parameters
+
+    Returns:
+        int: Number of runs published
+    """
+    count = 0
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=port, **params))
+    try:
+        channel = connection.channel()
+        channel.queue_declare(queue=queue, durable=True)
+        for run_id in run_ids:
+            channel.basic_publish(exchange='', routing_key=queue, body=run_id,
+                                  properties=pika.BasicProperties(delivery_mode=2))
+            count += 1
+    finally:
+        connection.close()
+    return count
+
+
+def run_server(con: Optional[Union[psycopg2.extensions.connection, Session]], run_path: str, out_path: str,
+               queue: str = 'runs', host: str = 'localhost', port: int = 5672, close: bool = False,
+               workers: Optional[int] = None, dsn: Optional[str] = None, stage_ahead: int = 0,
+               store_path: Optional[str] = None, metrics_table: Optional[str] = None,
+               metrics_port: Optional[int] = None, results_table: Optional[str] = None, load_results: bool = False,
+               retries: int = 2, **params):
     """Run a Citycatpg server that listens for messages on the specified queue
 
+    Messages are acknowledged once their run has completed. The message of a failed run is published again to the
+    back of the queue, with the number of attempts in its headers, until the run has failed retries + 1 times,
+    after which it is rejected and only the error is logged.
+
     Args:
-        con: Postgres connection
+        con: Postgres connection, not used if dsn is given. A Session lets the messages handled on threads
+            share its connections, and retrieves the inputs of each model concurrently
         run_path: Directory in which to create the model directory
         out_path: Directory in which to create the output netCDF file
         queue: Name of AQMP queue
         host: Hostname of AQMP server
         port: Port of AQMP server
         close: Whether to stop listening when the message count reaches zero
+        workers: Number of models to run concurrently using worker processes,
+            or threads if stage_ahead is given, each message is handled on a thread using con if not given
+        dsn: Postgres connection string used by each worker process or staging thread,
+            required if workers is given without stage_ahead
+        stage_ahead: Number of models to fetch and write in the background while other models are running
+        store_path: Directory of a content-addressed store used to link model input files rather than writing them
+        metrics_table: Postgres table in which to store the duration of each phase of each run, see Run.save_metrics
+        metrics_port: Port on which to serve the total duration of each phase in the Prometheus text format
+        results_table: Postgres table used to reuse the outputs of runs with the same configuration, including
+            redelivered messages, instead of executing CityCAT again, see ResultCache
+        load_results: Whether to load the maximum depths into postgres after each run, see results.write_results
+        retries: Number of times the message of a failed run is requeued
         **params: Pika connection parameters
     """
+    assert workers is None or stage_ahead > 0 or dsn is not None, 'dsn is required if workers is given'
 
-    def ack_message(ch, delivery_tag):
+    pending = set()
+    store = _input_store(store_path)
+    results = _result_cache(con, results_table) if con is not None else None
+    slots = workers if workers is not None else 1
+    stage_cons = threading.local()
+    opened_cons = []
+    metrics = Metrics(keep_phases=False)
+    metrics_server = serve_metrics(metrics, metrics_port) if metrics_port is not None else None
 
-        message_count = ch.queue_declare(queue=queue, durable=True).method.message_count
+    def stage_con():
+        if dsn is None:
+            return con
+        if not hasattr(stage_cons, 'con'):
+            stage_cons.con = psycopg2.connect(dsn)
+            stage_cons.results = _result_cache(stage_cons.con, results_table)
+            opened_cons.append(stage_cons.con)
+        return stage_cons.con
+
+    def stage_results():
+        if dsn is None:
+            return results
+        stage_con()
+        return stage_cons.results
+
+    def stage(run_id):
+        from .run import fetch
+
+        run = fetch(stage_con(), run_id)
+        run.get_model(stage_con())
+        run.write(run_path, store, release=True)
+        print(f'[{datetime.now().replace(microsecond=0)}] Staged {run_id}')
+        return run
+
+    def on_staged(conn, ch, delivery_tag, run_id, attempts, future: Future):
+        if future.exception() is not None:
+            on_done(conn, ch, delivery_tag, run_id, attempts, future)
+            return
+        future = solver.submit(finish, future.result())
+        future.add_done_callback(functools.partial(on_done, conn, ch, delivery_tag, run_id, attempts))
+
+    def finish(run):
+        from .results import write_results
 
-        ch.basic_ack(delivery_tag)
-        if message_count == 0 and close:
+        run.execute(run_path, out_path, True, results=stage_results())
+        with _checkout(stage_con()) as finish_con:
+            if load_results:
+                write_results(finish_con, run, out_path)
+            if metrics_table is not None:
+                run.save_metrics(finish_con, metrics_table)
+        return run.metrics.phases
+
+    def ack_message(ch, delivery_tag, run_id, attempts, success=True):
+
+        if success:
+            ch.basic_ack(delivery_tag)
+        elif attempts < retries:
+            ch.basic_publish(exchange='', routing_key=queue, body=run_id, properties=pika.BasicProperties(
+                delivery_mode=2, headers={_attempts_header: attempts + 1}))
+            ch.basic_ack(delivery_tag)
+            print(f'[{datetime.now().replace(microsecond=0)}] Requeued {run_id}')
+        else:
+            ch.basic_nack(delivery_tag, requeue=False)
+            print(f'[{datetime.now().replace(microsecond=0)}] Rejected {run_id} after {attempts + 1} attempts')
+        pending.discard(delivery_tag)
+
+        message_count = ch.queue_declare(queue=queue, durable=True).method.message_count
+        if message_count == 0 and close and not pending:
             ch.stop_consuming()
 
-    def do_work(conn, ch, delivery_tag, body):
-        run_id = body.decode('utf8')
-        print(f'[{datetime.now().replace(microsecond=0)}] Fetching {run_id}')
+    def work(run_id):
+        from .run import fetch
+        from .results import write_results
+
         run = fetch(con, run_id)
-        run.get_model(con)
-        run.execute(run_path, out_path)
-        print(f'[{datetime.now().replace(microsecond=0)}] Completed {run_id}')
-        cb = functools.partial(ack_message, ch, delivery_tag)
+        run.get_model(con, lazy=True)
+        run.execute(run_path, out_path, store=store, results=results)
+        with _checkout(con) as work_con:
+            if load_results:
+                write_results(work_con, run, out_path)
+            if metrics_table is not None:
+                run.save_metrics(work_con, metrics_table)
+        return run.metrics.phases
+
+    def do_work(conn, ch, delivery_tag, run_id, attempts):
+        future = Future()
+        try:
+            future.set_result(work(run_id))
+        except Exception as error:
+            future.set_exception(error)
+        on_done(conn, ch, delivery_tag, run_id, attempts, future)
+
+    def on_done(conn, ch, delivery_tag, run_id, attempts, future: Future):
+        error = future.exception()
+        if error is None:
+            metrics.extend(future.result())
+            print(f'[{datetime.now().replace(microsecond=0)}] Completed {run_id}')
+        else:
+            print(f'[{datetime.now().replace(microsecond=0)}] Failed {run_id}')
+            traceback.print_exception(type(error), error, error.__traceback__)
+        cb = functools.partial(ack_message, ch, delivery_tag, run_id, attempts, error is None)
         conn.add_callback_threadsafe(cb)
 
     def on_message(ch, method_frame, header_frame, body, args):
         (conn, th) = args
         delivery_tag = method_frame.delivery_tag
-        t = threading.Thread(target=do_work, args=(conn, ch, delivery_tag, body))
+        pending.add(delivery_tag)
+        run_id = body.decode('utf8')
+        attempts = (header_frame.headers or {}).get(_attempts_header, 0)
+        print(f'[{datetime.now().replace(microsecond=0)}] Fetching {run_id}')
+        if stager is not None:
+            future = stager.submit(stage, run_id)
+            future.add_done_callback(functools.partial(on_staged, conn, ch, delivery_tag, run_id, attempts))
+            return
+        if executor is not None:
+            future = executor.submit(_process_run, run_id, run_path, out_path, metrics_table=metrics_table,
+                                     load_results=load_results)
+            future.add_done_callback(functools.partial(on_done, conn, ch, delivery_tag, run_id, attempts))
+            return
+        t = threading.Thread(target=do_work, args=(conn, ch, delivery_tag, run_id, attempts))
         t.start()
-        th.append(t)
+        th[:] = [thread for thread in th if thread.is_alive()] + [t]
 
     parameters = pika.ConnectionParameters(host=host, port=port, **params)
     connection = pika.BlockingConnection(parameters)
 
     channel = connection.channel()
     channel.queue_declare(queue=queue, durable=True)
-    channel.basic_qos(prefetch_count=1)
+    channel.basic_qos(prefetch_count=slots + stage_ahead)
+
+    stager = ThreadPoolExecutor(max_workers=stage_ahead) if stage_ahead > 0 else None
+    solver = ThreadPoolExecutor(max_workers=slots) if stage_ahead > 0 else None
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                   initargs=(dsn, store_path, results_table)) \
+        if workers is not None and stager is None else None
 
     threads = []
     on_message_callback = functools.partial(on_message, args=(connection, threads))
@@ -65,5 +271,91 @@ def run_server(con: psycopg2.extensions.connection, run_path: str, out_path: str
     # Wait for all to complete
     for thread in threads:
         thread.join()
+    for pool in [stager, solver, executor]:
+        if pool is not None:
+            pool.shutdown(wait=True)
+    for opened_con in opened_cons:
+        opened_con.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
 
     connection.close()
+
+
+def run_queue_server(dsn: str, run_path: str, out_path: str, run_table: str = 'runs', workers: int = 1,
+                     lease: timedelta = timedelta(minutes=10), poll_interval: float = 10, close: bool = False,
+                     store_path: Optional[str] = None, metrics_table: Optional[str] = None,
+                     metrics_port: Optional[int] = None, results_table: Optional[str] = None,
+                     load_results: bool = False):
+    """Run a Citycatpg server that claims pending runs directly from the run_table
+
+    Runs are marked as pending using pgqueue.enqueue and claimed in batches using SELECT ... FOR UPDATE SKIP LOCKED,
+    so any number of servers can share a single postgres database without a message broker.
+
+    Args:
+        dsn: Postgres connection string used by the server and each worker process
+        run_path: Directory in which to create the model directory
+        out_path: Directory in which to create the output netCDF file
+        run_table: Postgres table where the run configurations are stored
+        workers: Number of worker processes used to run models concurrently
+        lease: Time after the last heartbeat before a run is claimed by another server
+        poll_interval: Number of seconds to wait between checking for pending runs
+        close: Whether to stop when there are no pending runs
+        store_path: Directory of a content-addressed store used to link model input files rather than writing them
+        metrics_table: Postgres table in which to store the duration of each phase of each run, see Run.save_metrics
+        metrics_port: Port on which to serve the total duration of each phase in the Prometheus text format
+        results_table: Postgres table used to reuse the outputs of runs with the same configuration instead of
+            executing CityCAT again, see ResultCache
+        load_results: Whether to load the maximum depths into postgres after each run, see results.write_results
+    """
+    worker = f'{socket.gethostname()}-{os.getpid()}'
+    con = psycopg2.connect(dsn)
+    pgqueue.create_queue(con, run_table)
+
+    running = {}
+    metrics = Metrics(keep_phases=False)
+    metrics_server = serve_metrics(metrics, metrics_port) if metrics_port is not None else None
+    last_heartbeat = time.monotonic()
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                   initargs=(dsn, store_path, results_table))
+
+    try:
+        while True:
+            claimed = pgqueue.claim(con, worker, workers - len(running), lease, run_table) \
+                if len(running) < workers else []
+            for run in claimed:
+                print(f'[{datetime.now().replace(microsecond=0)}] Claimed {run.run_id}')
+                future = executor.submit(_process_run, run.run_id, run_path, out_path, run_table, metrics_table,
+                                         load_results)
+                running[future] = run.run_id
+
+            if not running:
+                if close:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            done, _ = wait(running, timeout=min(poll_interval, lease.total_seconds() / 3),
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                run_id = running.pop(future)
+                error = future.exception()
+                if error is None:
+                    metrics.extend(future.result())
+                    print(f'[{datetime.now().replace(microsecond=0)}] Completed {run_id}')
+                else:
+                    print(f'[{datetime.now().replace(microsecond=0)}] Failed {run_id}')
+                    traceback.print_exception(type(error), error, error.__traceback__)
+                pgqueue.complete(con, worker, run_id, 'complete' if error is None else 'failed', run_table)
+
+            if running and time.monotonic() - last_heartbeat > lease.total_seconds() / 3:
+                pgqueue.heartbeat(con, worker, running.values(), run_table)
+                last_heartbeat = time.monotonic()
+
+    except KeyboardInterrupt:
+        pass
+
+    executor.shutdown(wait=True)
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    con.close()
@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+from typing import Union, Optional
+from psycopg2.extensions import connection, cursor
+from psycopg2 import sql
+import hashlib
+import re
+import threading
+import psycopg2
+import psycopg2.extensions
+
+_placeholder = re.compile(r'%\((\w+)\)s')
+
+
+class _Connection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class Session:
+    """Thread-safe pool of postgres connections that reuse server-side prepared statements
+
+    A session can be used in place of a connection by Run, fetch, fetch_many, iter_runs and run_server.
+    Connections are created when needed, up to maxconn, and threads wait for a connection once they are all in use.
+    Fixed-shape queries such as fetch and the metadata and domain lookups are prepared once on each connection.
+
+    Args:
+        dsn: Postgres connection string
+        maxconn: Maximum number of connections
+    """
+    def __init__(self, dsn: str, maxconn: int = 8):
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self._idle = []
+        self._lock = threading.Lock()
+        self._available = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self) -> connection:
+        """Check out a connection, waiting until one is available
+
+        Returns:
+            psycopg2.extensions.connection: Connection that must be returned using putconn
+        """
+        self._available.acquire()
+        try:
+            with self._lock:
+                if self._idle:
+                    return self._idle.pop()
+            return psycopg2.connect(self.dsn, connection_factory=_Connection)
+        except Exception:
+            self._available.release()
+            raise
+
+    def putconn(self, con: connection):
+        """Return a connection checked out using getconn
+
+        Args:
+            con: Postgres connection
+        """
+        if not con.closed:
+            if con.status != psycopg2.extensions.STATUS_READY:
+                con.rollback()
+            with self._lock:
+                self._idle.append(con)
+        self._available.release()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a with block"""
+        con = self.getconn()
+        try:
+            yield con
+        finally:
+            self.putconn(con)
+
+    def close(self):
+        """Close the idle connections"""
+        with self._lock:
+            for con in self._idle:
+                con.close()
+            self._idle = []
+
+
+@contextmanager
+def _checkout(con: Union[connection, Session, None]):
+    if isinstance(con, Session):
+        with con.connection() as session_con:
+            yield session_con
+    else:
+        yield con
+
+
+def _execute(cur: cursor, query: sql.Composable, params: Optional[dict] = None):
+    if not isinstance(cur.connection, _Connection):
+        cur.execute(query, params)
+        return
+
+    text = query.as_string(cur)
+    names = list(dict.fromkeys(_placeholder.findall(text)))
+    name = f'citycatpg_{hashlib.md5(text.encode()).hexdigest()[:16]}'
+    if name not in cur.connection.prepared:
+        statement = _placeholder.sub(lambda match: f'${names.index(match.group(1)) + 1}', text)
+        cur.execute(sql.SQL('PREPARE {name} AS ').format(name=sql.Identifier(name)).as_string(cur) + statement)
+        cur.connection.prepared.add(name)
+
+    if names:
+        cur.execute(sql.SQL('EXECUTE {name} ({params})').format(
+            name=sql.Identifier(name), params=sql.SQL(', ').join(map(sql.Placeholder, names))), params)
+    else:
+        cur.execute(sql.SQL('EXECUTE {name}').format(name=sql.Identifier(name)))
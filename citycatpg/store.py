@@ -0,0 +1,153 @@
+from citycatio import Model
+from citycatio import inputs
+from typing import Optional
+import geopandas as gpd
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+
+def _file_digest(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _component_digest(component) -> Optional[str]:
+    digest = hashlib.sha256(type(component).__name__.encode())
+    if type(component) == inputs.Dem:
+        digest.update(component.data.getbuffer())
+    elif type(component) in [inputs.Buildings, inputs.GreenAreas, inputs.OpenBoundaries, inputs.RainfallPolygons]:
+        geometry = component.data if type(component.data) == gpd.GeoSeries else component.data.geometry
+        for geom in geometry:
+            digest.update(geom.wkb)
+    else:
+        return None
+    return digest.hexdigest()
+
+
+class InputStore:
+    """Content-addressed store of model input files shared between runs
+
+    Model directories are assembled from links to the stored files so that identical DEMs, buildings,
+    green areas, boundaries, rainfall polygons and executables are only written to disk once.
+    Hard links are used where possible, falling back to symbolic links when the store is on another filesystem.
+
+    Args:
+        path: Directory in which to store the files
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._executables = {}
+        self._lock = threading.Lock()
+        for directory in ['objects', 'components']:
+            os.makedirs(os.path.join(path, directory), exist_ok=True)
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    def add(self, file_path: str) -> str:
+        """Move a file into the store
+
+        Args:
+            file_path: Path of the file to move
+
+        Returns:
+            str: SHA-256 digest of the file contents
+        """
+        digest = _file_digest(file_path)
+        object_path = self._object_path(digest)
+        if os.path.exists(object_path):
+            os.remove(file_path)
+        else:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(file_path, object_path)
+        return digest
+
+    def link(self, digest: str, file_path: str):
+        """Create a link to a stored file
+
+        Args:
+            digest: SHA-256 digest of the file contents
+            file_path: Path of the link to create
+        """
+        object_path = self._object_path(digest)
+        try:
+            os.link(object_path, file_path)
+        except OSError:
+            os.symlink(os.path.abspath(object_path), file_path)
+
+    def write_component(self, component, model_path: str):
+        """Write a model input to the model directory, linking to stored files if it has been written before
+
+        Args:
+            component: Citycatio input such as citycatio.inputs.Dem
+            model_path: Model directory
+        """
+        key = _component_digest(component)
+        if key is None:
+            component.write(model_path)
+            return
+
+        index_path = os.path.join(self.path, 'components', f'{key}.json')
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                files = json.load(f)
+            if all(os.path.exists(self._object_path(digest)) for digest in files.values()):
+                for file_name, digest in files.items():
+                    self.link(digest, os.path.join(model_path, file_name))
+                return
+
+        temp_path = tempfile.mkdtemp(dir=self.path)
+        try:
+            component.write(temp_path)
+            files = {file_name: self.add(os.path.join(temp_path, file_name)) for file_name in os.listdir(temp_path)}
+        finally:
+            shutil.rmtree(temp_path)
+
+        for file_name, digest in files.items():
+            self.link(digest, os.path.join(model_path, file_name))
+
+        with open(f'{index_path}.{os.getpid()}.{threading.get_ident()}.tmp', 'w') as f:
+            json.dump(files, f)
+        os.replace(f.name, index_path)
+
+    def write_model(self, model: Model, model_path: str):
+        """Create a model directory, equivalent to citycatio.Model.write
+
+        Args:
+            model: Citycatio Model object
+            model_path: Directory in which to create input files, will be replaced if it exists
+        """
+        if os.path.exists(model_path):
+            shutil.rmtree(model_path)
+        os.mkdir(model_path)
+        for component in [model.dem, model.rainfall, model.configuration, model.rainfall_polygons, model.buildings,
+                          model.green_areas, model.friction, model.open_boundaries]:
+            if component is not None:
+                self.write_component(component, model_path)
+
+    def link_executable(self, executable: str, model_path: str):
+        """Link an executable into a model directory, adding it to the store if it has changed
+
+        Args:
+            executable: Path of the executable
+            model_path: Model directory
+        """
+        stat = os.stat(executable)
+        key = (os.path.abspath(executable), stat.st_size, stat.st_mtime)
+        with self._lock:
+            digest = self._executables.get(key)
+        if digest is None or not os.path.exists(self._object_path(digest)):
+            temp_path = os.path.join(
+                self.path, f'{os.path.basename(executable)}.{os.getpid()}.{threading.get_ident()}.tmp')
+            shutil.copy(executable, temp_path)
+            digest = self.add(temp_path)
+            with self._lock:
+                self._executables[key] = digest
+        self.link(digest, os.path.join(model_path, os.path.basename(executable)))
@@ -0,0 +1,145 @@
+from citycatio.output import get_transform, path_to_step, path_to_time, datatype, fill_value
+from osgeo import osr
+from datetime import datetime
+from typing import Optional
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+import os
+import threading
+
+
+class NetCDFStream:
+    """Appends CityCAT results files to a netCDF file while the model is running
+
+    A results file is appended once a later time step has been written, or when update is called with final=True.
+    The netCDF file has the same layout as citycatio.output.to_netcdf but is chunked by time step.
+
+    Args:
+        in_path: Directory where CityCAT writes the results files
+        out_path: Path of the netCDF file to create
+        start_time: Start time to use when creating time steps
+        srid: EPSG Spatial Reference System Identifier of results files
+        attributes: Dictionary of key-value pairs to store as netCDF attributes
+        delete: Whether to delete each results file once it has been appended
+    """
+    def __init__(self, in_path: str, out_path: str, start_time: datetime = datetime(1, 1, 1),
+                 srid: Optional[int] = None, attributes: Optional[dict] = None, delete: bool = False):
+        self.in_path = in_path
+        self.out_path = out_path
+        self.start_time = start_time
+        self.srid = srid
+        self.attributes = attributes
+        self.delete = delete
+        self.steps = set()
+        self._ds = None
+        self._lock = threading.Lock()
+
+    def _create(self, file_path: str):
+        locations = pd.read_csv(file_path, usecols=['XCen', 'YCen'], delimiter=' ')
+        _, unique_x, unique_y, self._x_index, self._y_index = get_transform(locations.XCen, locations.YCen)
+
+        if os.path.exists(self.out_path):
+            os.remove(self.out_path)
+
+        ds = nc.Dataset(self.out_path, 'w', format='NETCDF4')
+        ds.createDimension('time', None)
+        ds.createDimension('x', len(unique_x))
+        ds.createDimension('y', len(unique_y))
+
+        chunks = (1, len(unique_y), len(unique_x))
+        for name, units in [('depth', 'm'), ('x_vel', 'm/s'), ('y_vel', 'm/s')]:
+            variable = ds.createVariable(name, datatype, ('time', 'y', 'x',), zlib=True, least_significant_digit=3,
+                                         chunksizes=chunks, fill_value=fill_value)
+            variable.units = units
+        x_var = ds.createVariable('x', datatype, ('x',), zlib=True)
+        y_var = ds.createVariable('y', datatype, ('y',), zlib=True)
+        times_var = ds.createVariable('time', 'f8', ('time',), zlib=True)
+
+        x_var.units = 'm'
+        y_var.units = 'm'
+        x_var[:] = unique_x
+        y_var[::-1] = unique_y
+
+        times_var.units = 'minutes since {:%Y-%m-%d}'.format(self.start_time).replace('-0', '-')
+        times_var.calendar = 'gregorian'
+        times_var.long_name = 'Time in minutes since {:%Y-%m-%d}'.format(self.start_time).replace('-0', '-')
+
+        if self.srid is not None:
+            srs = osr.SpatialReference()
+            srs.ImportFromEPSG(self.srid)
+            for name in ['depth', 'x_vel', 'y_vel']:
+                ds[name].grid_mapping = 'crs'
+
+            crs = ds.createVariable('crs', 'i4')
+            crs.spatial_ref = srs.ExportToWkt()
+            crs.grid_mapping_name = srs.GetAttrValue('projection').lower()
+            crs.scale_factor_at_central_meridian = srs.GetProjParm('scale_factor')
+            crs.longitude_of_central_meridian = srs.GetProjParm('central_meridian')
+            crs.latitude_of_projection_origin = srs.GetProjParm('latitude_of_origin')
+            crs.false_easting = srs.GetProjParm('false_easting')
+            crs.false_northing = srs.GetProjParm('false_northing')
+
+        ds.Conventions = 'CF-1.6'
+        ds.institution = 'Newcastle University'
+        ds.source = 'CityCAT Model Results'
+        ds.references = 'Glenis, V., Kutija, V. & Kilsby, C.G. (2018) ' \
+                        'A fully hydrodynamic urban flood modelling system ' \
+                        'representing buildings, green space and interventions. ' \
+                        'Environmental Modelling and Software. 109 (August), 272–292'
+        ds.title = 'CityCAT Model Results'
+        ds.history = 'Created {}'.format(datetime.now())
+
+        self._ds = ds
+        self._array = np.full((len(unique_y), len(unique_x)), fill_value)
+
+    def _append(self, file_path: str):
+        if self._ds is None:
+            self._create(file_path)
+
+        step = path_to_step(file_path)
+        variables = pd.read_csv(file_path, usecols=['Depth', 'Vx', 'Vy'], delimiter=' ')
+        for name, column in [('depth', 'Depth'), ('x_vel', 'Vx'), ('y_vel', 'Vy')]:
+            self._array[self._y_index, self._x_index] = variables[column].values
+            self._ds[name][step, :, :] = self._array
+        self._ds['time'][step] = path_to_time(file_path)
+        self._ds.sync()
+
+        self.steps.add(step)
+        if self.delete:
+            os.remove(file_path)
+
+    def update(self, final: bool = False) -> int:
+        """Append the results files that have been completely written
+
+        Args:
+            final: Whether the model has finished, in which case every remaining results file is appended
+
+        Returns:
+            int: Number of time steps appended so far
+        """
+        with self._lock:
+            if os.path.exists(self.in_path):
+                file_paths = [os.path.join(self.in_path, file_name) for file_name in os.listdir(self.in_path)
+                              if file_name.lower().endswith('.rsl')]
+                file_paths = [path for path in file_paths if path_to_step(path) not in self.steps]
+                file_paths.sort(key=path_to_step)
+
+                if not final:
+                    file_paths = file_paths[:-1]
+
+                for file_path in file_paths:
+                    self._append(file_path)
+
+            return len(self.steps)
+
+    def close(self):
+        """Write the attributes and close the netCDF file"""
+        with self._lock:
+            if self._ds is None:
+                return
+            if self.attributes is not None:
+                for key, value in self.attributes.items():
+                    self._ds.setncattr(key, value)
+            self._ds.close()
+            self._ds = None
@@ -0,0 +1,113 @@
+from .run import Run, add_many, _get_inputs
+from .cache import DomainCache
+from .server import publish
+from dataclasses import replace
+from typing import Optional, List, Union, Iterable
+from psycopg2.extensions import connection
+from psycopg2.pool import AbstractConnectionPool
+import itertools
+import uuid
+
+
+class Sweep:
+    """Ensemble of runs created from every combination of the given parameter values
+
+    The DEM, domain, buildings and green areas are retrieved once for each domain and gridded rainfall is retrieved
+    once for the period covering every member, so preparing the members only requires a few spatial queries
+
+    Args:
+        base: Configuration shared by every member
+        **grids: Values of each Run parameter to sweep, for example rain_total=[10, 20, 40]
+
+    Attributes:
+        members (list): Configuration of each member
+    """
+    def __init__(self, base: Run, **grids: Iterable):
+        assert 'run_id' not in grids, 'run_id cannot be swept'
+        self.base = base
+        self.grids = {name: list(values) for name, values in grids.items()}
+        self.members = [replace(base, run_id=str(uuid.uuid4()), model=None, **dict(zip(self.grids, values)))
+                        for values in itertools.product(*self.grids.values())]
+        self._rainfall = {}
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def get_models(self, con: Optional[connection], open_boundaries: bool = True,
+                   pool: Optional[Union[AbstractConnectionPool, str]] = None, cache: Optional[DomainCache] = None,
+                   tiled_dem: bool = False, lazy: bool = False) -> List[Run]:
+        """Create the Model of every member, see Run.get_model
+
+        Use lazy to avoid holding the Model of every member at once, each Model is then created from the shared
+        inputs when the member is written or executed and can be freed using release
+
+        Args:
+            con: Postgres connection, not used if pool is given
+            open_boundaries: Whether to treat domain boundaries as open
+            pool: Thread-safe connection pool or DSN used to retrieve the inputs concurrently
+            cache: Cache used to share the DEM, domain, buildings and green areas, a new cache is used if not given
+            tiled_dem: Whether to stream the DEM tiles and mosaic them locally, see Run.get_dem
+            lazy: Whether to wait until each Model is required before creating it
+
+        Returns:
+            List[Run]: Members with the model attribute set, unless lazy is True
+        """
+        if cache is None:
+            cache = DomainCache(maxsize=len(self.members) * 4)
+        self._rainfall = {}
+
+        for member in self.members:
+            assert member.rain_table is not None or member.rain_total is not None
+            getters = member._getters(open_boundaries, cache, tiled_dem,
+                                      rainfall=lambda c, member=member: self._get_rainfall(c, member))
+            member.model = None
+            member._loader = lambda member=member, getters=getters: member._build_model(
+                _get_inputs(con, getters, pool), open_boundaries)
+            if not lazy:
+                member._require_model()
+
+        return self.members
+
+    def _get_rainfall(self, con: connection, member: Run):
+        if member.rain_total is not None:
+            return member.get_rainfall(con)
+
+        key = (member.rain_table, member.metadata_table, member.domain_table, member.domain_id)
+        if key not in self._rainfall:
+            members = [m for m in self.members if m.rain_total is None and
+                       (m.rain_table, m.metadata_table, m.domain_table, m.domain_id) == key]
+            assert all(m.rain_start and m.rain_end for m in members), \
+                'Rain start and end times are required if rain total is not given'
+            start = min(m.rain_start for m in members)
+            self._rainfall[key] = start, replace(
+                member, run_id=None, model=None, rain_start=start,
+                rain_end=max(m.rain_end for m in members)).get_rainfall(con)
+
+        start, (rain, geom) = self._rainfall[key]
+        offset = int((member.rain_start - start).total_seconds())
+        rain = rain.loc[offset:int((member.rain_end - start).total_seconds())].copy()
+        rain.index = rain.index - offset
+        return rain, geom
+
+    def add(self, con: connection, page_size: int = 1000) -> List[str]:
+        """Insert every member into the run_table of the base configuration
+
+        Args:
+            con: Postgres connection
+            page_size: Number of members inserted in each statement
+
+        Returns:
+            List[str]: Unique identifiers of the members
+        """
+        return add_many(con, self.members, self.base.run_table, page_size)
+
+    def publish(self, queue: str = 'runs', host: str = 'localhost', port: int = 5672, **params):
+        """Publish every member to a queue using a single connection
+
+        Args:
+            queue: Name of AQMP queue
+            host: Hostname of AQMP server
+            port: Port of AQMP server
+            **params: Pika connection parameters
+        """
+        publish([member.run_id for member in self.members], queue, host, port, **params)
@@ -0,0 +1,208 @@
+from .run import Run
+from dataclasses import replace
+from typing import List, Iterable, Dict, Tuple
+from psycopg2.extensions import connection
+from psycopg2 import sql
+from rasterio.transform import from_origin
+from rasterio.windows import from_bounds
+import netCDF4 as nc
+import numpy as np
+import rasterio as rio
+import math
+import os
+import uuid
+
+
+def split_domain(con: connection, run: Run, tile_size: float, overlap: float,
+                 tiles_table: str = 'domain_tiles') -> List[Run]:
+    """Split the domain of a run into overlapping tiles and create a run for each tile
+
+    Each tile is stored in the tiles_table with its core, the part of the tile that is not shared with its neighbours.
+    Tile edges are aligned to the DEM grid, existing tiles of the domain are replaced.
+
+    Args:
+        con: Postgres connection
+        run: Configuration of the whole domain
+        tile_size: Width and height of the core of each tile in metres, rounded to a multiple of the DEM resolution
+        overlap: Distance the tiles extend beyond their core in metres
+        tiles_table: Postgres table in which to store the tiles
+
+    Returns:
+        List[Run]: Configuration of each tile, using the tiles_table as the domain_table
+    """
+    with con:
+        with con.cursor() as cur:
+            cur.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {tiles_table} (
+                gid serial PRIMARY KEY,
+                parent_table text,
+                parent_id integer,
+                tile_row integer,
+                tile_col integer,
+                core geometry,
+                geom geometry
+            );
+            DELETE FROM {tiles_table} WHERE parent_table = %(domain_table)s AND parent_id = %(domain_id)s;
+
+            SELECT ST_XMin(geom), ST_YMin(geom), ST_XMax(geom), ST_YMax(geom),
+                abs(ST_ScaleX(rast)), ST_UpperLeftX(rast), ST_UpperLeftY(rast)
+            FROM {domain_table}, (SELECT rast FROM {dem_table} LIMIT 1) AS dem
+            WHERE gid = %(domain_id)s
+            """).format(
+                tiles_table=sql.Identifier(tiles_table),
+                domain_table=sql.Identifier(run.domain_table),
+                dem_table=sql.Identifier(run.dem_table)), run.__dict__)
+            assert cur.rowcount == 1, f'Domain {run.domain_id} missing from {run.domain_table}'
+            x_min, y_min, x_max, y_max, res, origin_x, origin_y = cur.fetchone()
+
+            tile_size = max(round(tile_size / res), 1) * res
+            left = origin_x + math.floor((x_min - origin_x) / res) * res
+            top = origin_y + math.ceil((y_max - origin_y) / res) * res
+
+            tiles = []
+            for row in range(math.ceil((top - y_min) / tile_size)):
+                for col in range(math.ceil((x_max - left) / tile_size)):
+                    core = (left + col * tile_size, top - (row + 1) * tile_size,
+                            left + (col + 1) * tile_size, top - row * tile_size)
+                    cur.execute(sql.SQL("""
+                    INSERT INTO {tiles_table} (parent_table, parent_id, tile_row, tile_col, core, geom)
+                    SELECT %(domain_table)s, gid, %(row)s, %(col)s, core,
+                        ST_Intersection(geom, ST_Expand(core, %(overlap)s))
+                    FROM {domain_table}, ST_MakeEnvelope(%(x_min)s, %(y_min)s, %(x_max)s, %(y_max)s, ST_SRID(geom))
+                        AS core
+                    WHERE gid = %(domain_id)s AND ST_Intersects(geom, core)
+                    RETURNING gid
+                    """).format(
+                        tiles_table=sql.Identifier(tiles_table),
+                        domain_table=sql.Identifier(run.domain_table)),
+                        dict(domain_table=run.domain_table, domain_id=run.domain_id, row=row, col=col,
+                             overlap=overlap, x_min=core[0], y_min=core[1], x_max=core[2], y_max=core[3]))
+                    tiles.extend(gid for gid, in cur.fetchall())
+
+    return [replace(run, run_id=str(uuid.uuid4()), model=None, domain_table=tiles_table, domain_id=gid)
+            for gid in tiles]
+
+
+def get_cores(con: connection, runs: Iterable[Run]) -> Dict[str, Tuple[float, float, float, float]]:
+    """Get the bounds of the core of the tile of each run
+
+    Args:
+        con: Postgres connection
+        runs: Configurations created using split_domain
+
+    Returns:
+        Dict[str, Tuple[float, float, float, float]]: Left, bottom, right and top of the core of each run
+    """
+    cores = {}
+    with con:
+        with con.cursor() as cur:
+            for run in runs:
+                cur.execute(sql.SQL("""
+                SELECT ST_XMin(core), ST_YMin(core), ST_XMax(core), ST_YMax(core) FROM {tiles_table}
+                WHERE gid = %(domain_id)s
+                """).format(tiles_table=sql.Identifier(run.domain_table)), run.__dict__)
+                assert cur.rowcount == 1, f'Tile {run.domain_id} missing from {run.domain_table}'
+                cores[run.run_id] = cur.fetchone()
+    return cores
+
+
+def mosaic(con: connection, runs: Iterable[Run], out_path: str, name: str):
+    """Merge the netCDF and GeoTIFF files of tiled runs, using the values from the core of each tile
+
+    Args:
+        con: Postgres connection
+        runs: Configurations created using split_domain that have been executed
+        out_path: Directory containing the output files of each run, in which to create the merged files
+        name: Name of the merged files, without an extension
+    """
+    runs = list(runs)
+    cores = get_cores(con, runs)
+    for extension, function in [('tif', mosaic_geotiff), ('nc', mosaic_netcdf)]:
+        function({os.path.join(out_path, f'{run.run_name}-{run.run_id}.{extension}'): cores[run.run_id]
+                  for run in runs}, os.path.join(out_path, f'{name}.{extension}'))
+
+
+def mosaic_geotiff(cores: Dict[str, Tuple[float, float, float, float]], file_path: str):
+    """Merge GeoTIFF files, using the cells within the core of each file
+
+    Args:
+        cores: Left, bottom, right and top of the core of each file
+        file_path: Path of the merged file to create
+    """
+    left, bottom = [min(core[i] for core in cores.values()) for i in [0, 1]]
+    right, top = [max(core[i] for core in cores.values()) for i in [2, 3]]
+
+    with rio.open(next(iter(cores))) as src:
+        profile = src.profile
+        res = src.res[0]
+    width, height = round((right - left) / res), round((top - bottom) / res)
+    profile.update(width=width, height=height, transform=from_origin(left, top, res, res))
+
+    array = np.full((height, width), profile['nodata'], dtype=profile['dtype'])
+    for path, core in cores.items():
+        with rio.open(path) as src:
+            tile = src.read(1, window=from_bounds(*core, src.transform), boundless=True, fill_value=profile['nodata'],
+                            out_shape=(round((core[3] - core[1]) / res), round((core[2] - core[0]) / res)))
+        row, col = round((top - core[3]) / res), round((core[0] - left) / res)
+        array[row:row + tile.shape[0], col:col + tile.shape[1]] = tile
+
+    with rio.open(file_path, 'w', **profile) as dst:
+        dst.write(array, 1)
+
+
+def mosaic_netcdf(cores: Dict[str, Tuple[float, float, float, float]], file_path: str):
+    """Merge netCDF files created by citycatio.output.to_netcdf, using the cells within the core of each file
+
+    Args:
+        cores: Left, bottom, right and top of the core of each file
+        file_path: Path of the merged file to create
+    """
+    datasets = {path: nc.Dataset(path) for path in cores}
+    try:
+        first = next(iter(datasets.values()))
+        res = float(np.diff(first['x'][:]).min())
+        left, bottom = [min(core[i] for core in cores.values()) for i in [0, 1]]
+        right, top = [max(core[i] for core in cores.values()) for i in [2, 3]]
+        x = left + res / 2 + res * np.arange(round((right - left) / res))
+        y = top - res / 2 - res * np.arange(round((top - bottom) / res))
+        for ds in datasets.values():
+            assert len(ds['time']) == len(first['time']), 'Tiles must have the same number of time steps'
+
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        with nc.Dataset(file_path, 'w', format='NETCDF4') as out:
+            out.setncatts(first.__dict__)
+            out.createDimension('time', None)
+            out.createDimension('x', len(x))
+            out.createDimension('y', len(y))
+            grids = []
+            for name, variable in first.variables.items():
+                options = variable.filters() or {}
+                created = out.createVariable(
+                    name, variable.dtype, variable.dimensions, zlib=bool(options.get('zlib')),
+                    fill_value=getattr(variable, '_FillValue', None))
+                created.setncatts({key: value for key, value in variable.__dict__.items() if key != '_FillValue'})
+                if variable.dimensions == ('time', 'y', 'x'):
+                    grids.append(name)
+            out['x'][:] = x
+            out['y'][:] = y
+            out['time'][:] = first['time'][:]
+            if 'crs' in first.variables:
+                out['crs'].assignValue(first['crs'].getValue())
+
+            for path, ds in datasets.items():
+                core_left, core_bottom, core_right, core_top = cores[path]
+                tile_x, tile_y = ds['x'][:], ds['y'][:]
+                columns = np.flatnonzero((tile_x > core_left) & (tile_x < core_right))
+                rows = np.flatnonzero((tile_y > core_bottom) & (tile_y < core_top))
+                if len(columns) == 0 or len(rows) == 0:
+                    continue
+                tile_window = slice(rows[0], rows[-1] + 1), slice(columns[0], columns[-1] + 1)
+                row, col = round((top - tile_y[rows[0]]) / res - 0.5), round((tile_x[columns[0]] - left) / res - 0.5)
+                out_window = slice(row, row + len(rows)), slice(col, col + len(columns))
+                for name in grids:
+                    for step in range(len(ds['time'])):
+                        out[name][(step, *out_window)] = ds[name][(step, *tile_window)]
+    finally:
+        for ds in datasets.values():
+            ds.close()
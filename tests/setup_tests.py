@@ -6,7 +6,8 @@ import psycopg2
 from psycopg2 import sql
 from citycatpg import Run
 
-con = psycopg2.connect(database='test', user='postgres', password='password', host='localhost')
+dsn = 'dbname=test user=postgres password=password host=localhost'
+con = psycopg2.connect(dsn)
 
 dem_file = rio.MemoryFile()
 x_min, y_max, res, height, width = 100, 500, 5, 100, 200
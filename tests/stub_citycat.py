@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+"""Stub CityCAT executable that creates results files after STUB_CITYCAT_DURATION seconds"""
+import os
+import time
+
+duration = float(os.getenv('STUB_CITYCAT_DURATION', '0'))
+steps = 3
+
+os.mkdir('R1C1_SurfaceMaps')
+for step in range(steps):
+    time.sleep(duration / steps)
+    with open(os.path.join('R1C1_SurfaceMaps', f'R1_C1_T{step}_{step}min.rsl'), 'w') as f:
+        f.write('XCen YCen Depth Vx Vy\n')
+        for x in range(3):
+            for y in range(3):
+                f.write(f'{x} {y} {step / 10} 0 0\n')
+
+with open(os.path.join('R1C1_SurfaceMaps', 'R1_C1_max_depth.csv'), 'w') as f:
+    f.write('XCen,YCen,Depth\n')
+    for x in range(3):
+        for y in range(3):
+            f.write(f'{x},{y},{(steps - 1) / 10}\n')
@@ -0,0 +1,97 @@
+from citycatpg import Run, DomainCache, ResultCache, rainfall
+from unittest import TestCase, mock
+from .setup_tests import con
+import asyncio
+import datetime
+import os
+
+
+class TestCache(TestCase):
+
+    def test_get_model(self):
+        cache = DomainCache(path='tests/test_cache')
+        cache.invalidate()
+        for rain_total in [100, 200]:
+            run = Run(100, rain_total=rain_total, rain_duration=100, domain_id=500,
+                      buildings_table='buildings', green_areas_table='green_areas')
+            run.get_model(con, cache=cache)
+            run.model.write('tests/test_model_cache')
+
+        self.assertEqual(len(cache._items), 4)
+
+        run = Run(100, rain_table='rain', rain_start=datetime.datetime(2000, 1, 1),
+                  rain_end=datetime.datetime(2000, 1, 2), domain_id=500)
+        run.get_model(con, cache=DomainCache(path='tests/test_cache'))
+
+    def test_invalidate(self):
+        cache = DomainCache()
+        cache.get(('buildings', 'buildings', 'domain', 500), lambda: 'buildings')
+        cache.get(('green_areas', 'green_areas', 'domain', 500), lambda: 'green_areas')
+        cache.refresh(con)
+        cache.refresh(con)
+        self.assertEqual(len(cache._items), 2)
+
+        cache.invalidate('buildings')
+        self.assertEqual(cache.get(('buildings', 'buildings', 'domain', 500), lambda: 'reloaded'), 'reloaded')
+
+        cache.invalidate('domain')
+        self.assertEqual(len(cache._items), 0)
+
+    @mock.patch.dict(os.environ, {'CITYCAT': os.path.abspath('tests/stub_citycat.py')})
+    def test_result_cache(self):
+        with con:
+            with con.cursor() as cur:
+                cur.execute('DROP TABLE IF EXISTS run_results')
+        results = ResultCache(con)
+        runs = [Run(run_duration=120, rain_total=100, rain_duration=100, run_name='test', output_frequency=60,
+                    domain_id=500) for _ in range(2)]
+        self.assertEqual(results.key(runs[0]), results.key(runs[1]))
+
+        for run in runs:
+            run.get_model(con)
+            asyncio.run(run.execute_async('tests/test_model_results', 'tests/test_model_results', results=results))
+
+        self.assertFalse(os.path.exists(f'tests/test_model_results/{runs[1].run_name}-{runs[1].run_id}'))
+        for extension in ['nc', 'tif']:
+            self.assertTrue(os.path.samefile(
+                *[f'tests/test_model_results/{run.run_name}-{run.run_id}.{extension}' for run in runs]))
+
+        asyncio.run(runs[0].execute_async('tests/test_model_results', 'tests/test_model_results', results=results))
+        self.assertNotEqual(results.key(runs[0]), results.key(Run(run_duration=120, rain_total=200, rain_duration=100,
+                                                                   domain_id=500)))
+
+    def test_result_cache_checksum(self):
+        results = ResultCache(con, checksum=True)
+        run = Run(run_duration=120, rain_total=100, rain_duration=100, domain_id=500, buildings_table='buildings')
+        key = results.key(run)
+
+        with con:
+            with con.cursor() as cur:
+                cur.execute('INSERT INTO buildings (gid, geom) SELECT 999999, geom FROM buildings WHERE gid = 500')
+        self.assertNotEqual(results.key(run), key)
+
+        with con:
+            with con.cursor() as cur:
+                cur.execute('DELETE FROM buildings WHERE gid = 999999')
+        self.assertEqual(results.key(run), key)
+
+    def test_result_cache_chunks(self):
+        with con:
+            with con.cursor() as cur:
+                cur.execute("""
+                DROP TABLE IF EXISTS rain_chunked, rain_chunked_chunks;
+                CREATE TABLE rain_chunked AS SELECT * FROM rain;
+                DELETE FROM metadata WHERE dataset = 'rain_chunked';
+                INSERT INTO metadata (dataset, frequency, start) VALUES ('rain_chunked', '1 day', '2000-01-01');
+                """)
+        rainfall.compact(con, 'rain_chunked', chunk_size=2)
+
+        results = ResultCache(con, checksum=True)
+        run = Run(run_duration=120, rain_table='rain_chunked', rain_start=datetime.datetime(2000, 1, 1),
+                  rain_end=datetime.datetime(2000, 1, 2), domain_id=500)
+        key = results.key(run)
+
+        with con:
+            with con.cursor() as cur:
+                cur.execute("UPDATE rain_chunked_chunks SET data = decode(repeat('00', 8), 'hex')")
+        self.assertNotEqual(results.key(run), key)
@@ -0,0 +1,46 @@
+from citycatpg import Run, add_many, pgqueue
+from citycatpg.__main__ import main
+from unittest import TestCase, mock
+from .setup_tests import con, dsn
+import io
+import os
+import subprocess
+import sys
+
+
+class TestMain(TestCase):
+
+    def test_lazy_imports(self):
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, citycatpg, citycatpg.__main__, citycatpg.server, citycatpg.pgqueue; '
+            'print([m for m in ["geopandas", "rasterio", "citycatio"] if m in sys.modules])'])
+        self.assertEqual(output.decode().strip(), '[]')
+
+    def test_submit_status(self):
+        with con:
+            with con.cursor() as cur:
+                cur.execute('DROP TABLE IF EXISTS runs')
+        run_ids = add_many(con, [Run(run_duration=120, rain_total=100, rain_duration=120, run_name='test',
+                                     output_frequency=60, domain_id=500) for _ in range(3)])
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout, \
+                mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            main(['status', '--dsn', dsn])
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertIn('has not been set up as a queue', stderr.getvalue())
+        with self.assertRaises(SystemExit):
+            main(['submit', '--pgqueue', '--dsn', dsn, *run_ids])
+        main(['setup', '--dsn', dsn])
+        main(['submit', '--pgqueue', '--dsn', dsn, *run_ids[:2]])
+        with mock.patch('sys.stdin', io.StringIO(f'{run_ids[2]}\n')):
+            main(['submit', '--pgqueue', '--dsn', dsn])
+        self.assertDictEqual(pgqueue.counts(con), {'pending': 3})
+
+        main(['worker', '--pgqueue', '--dsn', dsn, '--run-path', os.path.abspath('tests/test_model_from_cli'),
+              '--out-path', os.path.abspath('tests/test_model_from_cli'), '--workers', '2', '--close'])
+        self.assertDictEqual(pgqueue.counts(con), {'complete': 3})
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            main(['status', '--dsn', dsn])
+        self.assertEqual(stdout.getvalue(), 'complete\t3\n')
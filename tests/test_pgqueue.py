@@ -0,0 +1,37 @@
+from citycatpg import Run, add_many, pgqueue, run_queue_server
+from unittest import TestCase
+from .setup_tests import con, dsn
+from datetime import timedelta
+import os
+
+
+class TestQueue(TestCase):
+
+    def setUp(self):
+        with con:
+            with con.cursor() as cur:
+                cur.execute('DROP TABLE IF EXISTS runs')
+        self.run_ids = add_many(con, [Run(run_duration=120, rain_total=100, rain_duration=120, run_name='test',
+                                          output_frequency=60, domain_id=500) for _ in range(3)])
+        pgqueue.create_queue(con)
+        pgqueue.enqueue(con, self.run_ids)
+
+    def test_claim(self):
+        claimed = pgqueue.claim(con, 'a', batch_size=2)
+        self.assertEqual(len(claimed), 2)
+
+        claimed += pgqueue.claim(con, 'b', batch_size=2)
+        self.assertSetEqual({run.run_id for run in claimed}, set(self.run_ids))
+        self.assertListEqual(pgqueue.claim(con, 'c'), [])
+
+        pgqueue.complete(con, 'b', claimed[-1].run_id)
+        self.assertEqual(len(pgqueue.claim(con, 'c', batch_size=3, lease=timedelta(0))), 2)
+
+    def test_run_queue_server(self):
+        run_queue_server(dsn, run_path=os.path.abspath('tests/test_model_from_pg_queue'),
+                         out_path=os.path.abspath('tests/test_model_from_pg_queue'), workers=2, close=True)
+
+        with con:
+            with con.cursor() as cur:
+                cur.execute("SELECT count(*) FROM runs WHERE status = 'complete'")
+                self.assertEqual(cur.fetchone()[0], 3)
@@ -0,0 +1,28 @@
+from citycatpg import Run, rainfall
+from unittest import TestCase
+from .setup_tests import con
+import datetime
+import numpy as np
+
+
+class TestRainfall(TestCase):
+
+    def test_compact(self):
+        with con:
+            with con.cursor() as cur:
+                cur.execute("""
+                DROP TABLE IF EXISTS rain_compact;
+                CREATE TABLE rain_compact AS SELECT * FROM rain;
+                DELETE FROM metadata WHERE dataset = 'rain_compact';
+                INSERT INTO metadata (dataset, frequency, start) VALUES ('rain_compact', '1 day', '2000-01-01');
+                """)
+        self.assertEqual(rainfall.compact(con, 'rain_compact', chunk_size=2), 3)
+
+        for start, end in [(1, 3), (2, 2), (2, 5), (4, 8)]:
+            runs = [Run(100, rain_table=rain_table, rain_start=datetime.datetime(2000, 1, start),
+                        rain_end=datetime.datetime(2000, 1, end), domain_id=500)
+                    for rain_table in ['rain', 'rain_compact']]
+            (rain, geom), (compact, compact_geom) = [run.get_rainfall(con) for run in runs]
+            self.assertListEqual(list(rain.index), list(compact.index))
+            self.assertTrue(np.allclose(rain.values, compact.values))
+            self.assertTrue(geom.equals(compact_geom))
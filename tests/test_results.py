@@ -0,0 +1,34 @@
+from citycatpg import Run, results
+from unittest import TestCase
+from rasterio.transform import from_origin
+from .setup_tests import con
+import numpy as np
+import rasterio as rio
+import os
+
+
+class TestResults(TestCase):
+
+    def test_write_results(self):
+        run = Run(run_duration=120, rain_total=100, rain_duration=100, run_name='test', domain_id=500,
+                  buildings_table='buildings', green_areas_table='green_areas')
+        os.makedirs('tests/test_results', exist_ok=True)
+        depth = np.full((10, 20), 0.5)
+        depth[0, 0] = -999
+        with rio.open(f'tests/test_results/{run.run_name}-{run.run_id}.tif', 'w', driver='GTiff', width=20,
+                      height=10, count=1, dtype='float64', nodata=-999, transform=from_origin(100, 500, 50, 50)) as dst:
+            dst.write(depth, 1)
+
+        for _ in range(2):
+            results.write_results(con, run, 'tests/test_results', tile_size=8)
+
+        with con.cursor() as cur:
+            cur.execute('SELECT count(*), max(ST_Width(rast)), ST_SRID(ST_Union(rast)) FROM max_depth '
+                        'WHERE run_id = %s', (run.run_id,))
+            self.assertEqual(cur.fetchone(), (6, 8, 27700))
+            cur.execute('SELECT ST_Value(rast, 2, 1), ST_Value(rast, 1, 1) FROM max_depth WHERE run_id = %s '
+                        'AND ST_UpperLeftX(rast) = 100 AND ST_UpperLeftY(rast) = 500', (run.run_id,))
+            self.assertEqual(cur.fetchone(), (0.5, None))
+            cur.execute('SELECT source_table, gid, max_depth FROM max_depth_features WHERE run_id = %s ORDER BY 1',
+                        (run.run_id,))
+            self.assertListEqual(cur.fetchall(), [('buildings', 500, 0.5), ('green_areas', 500, 0.5)])
@@ -1,7 +1,40 @@
-from citycatpg import Run, fetch
+from citycatpg import Run, InputStore, Metrics, fetch, fetch_many, iter_runs, add_many, execute_many
 from unittest import TestCase
-from .setup_tests import con
+from .setup_tests import con, dsn
+from psycopg2 import sql
+from shapely.geometry import box
 import datetime
+import asyncio
+import os
+import geopandas as gpd
+import pandas as pd
+from unittest import mock
+
+
+def _explode_rainfall(run: Run, start: datetime.datetime, frequency: datetime.timedelta):
+    """Gridded rainfall built using the explode and pivot implementation that get_rainfall replaced"""
+    idx_min = ((run.rain_start - start) / frequency) + 1
+    idx_max = ((run.rain_end - start) / frequency) + 1
+    rain = gpd.GeoDataFrame.from_postgis(sql.SQL("""
+    SELECT {rain_table}.geom, series[{idx_min}:{idx_max}]
+    FROM {rain_table}, {domain_table}
+    WHERE ST_Intersects({rain_table}.geom, {domain_table}.geom)
+    AND {domain_table}.gid={domain_id}
+    """).format(
+        idx_min=sql.Literal(idx_min),
+        idx_max=sql.Literal(idx_max),
+        rain_table=sql.Identifier(run.rain_table),
+        domain_table=sql.Identifier(run.domain_table),
+        domain_id=sql.Literal(run.domain_id)
+    ).as_string(con), con)
+    geom = rain.geom
+    rain = rain.series.explode()
+    rain = pd.DataFrame({'values': rain.values, 'index': list(range(len(rain[0]))) * len(geom),
+                         'columns': rain.index}).pivot(values='values', index='index', columns='columns')
+    rain = rain.astype(float) / frequency.total_seconds() / 1000
+    rain.index = pd.date_range(start=run.rain_start, freq=frequency, periods=len(rain))
+    rain.index = (rain.index - rain.index[0]).total_seconds().astype(int)
+    return rain, geom
 
 
 class TestRun(TestCase):
@@ -15,6 +48,16 @@ class TestRun(TestCase):
         run.add(con)
         return run
 
+    def test_add_many(self):
+        with con:
+            with con.cursor() as cur:
+                cur.execute('DROP TABLE IF EXISTS runs')
+        runs = [Run(run_duration=120, rain_total=total, rain_duration=120, run_name='test', domain_id=500)
+                for total in range(1, 101)]
+        run_ids = add_many(con, runs, page_size=30)
+        self.assertListEqual(run_ids, [run.run_id for run in runs])
+        self.assertEqual(fetch(con, run_id=run_ids[-1]).rain_total, 100)
+
     def test_fetch(self):
         with con:
             with con.cursor() as cur:
@@ -27,11 +70,74 @@ class TestRun(TestCase):
 
             fetch(con, run_id=run.run_id).get_model(con)
 
+    def test_fetch_many(self):
+        with con:
+            with con.cursor() as cur:
+                cur.execute('DROP TABLE IF EXISTS runs')
+        runs = [Run(run_duration=duration, rain_total=100, rain_duration=120, run_name='test', domain_id=500)
+                for duration in range(100, 110)]
+        run_ids = add_many(con, runs)
+
+        fetched = list(fetch_many(con, run_ids[:5], itersize=2))
+        self.assertSetEqual({run.run_id for run in fetched}, set(run_ids[:5]))
+
+        fetched = list(iter_runs(con, dict(run_name='test', run_duration=105)))
+        self.assertEqual(len(fetched), 1)
+        self.assertEqual(fetched[0].run_id, runs[5].run_id)
+
     def test_generate_rainfall(self):
         run = Run(100, rain_total=100, rain_duration=500, domain_id=500)
         run.get_model(con)
         run.model.write('tests/test_model_generated')
 
+    def test_get_dem_tiled(self):
+        run = Run(100, rain_total=100, rain_duration=100, domain_id=500)
+        with run.get_dem(con).open() as dem, run.get_dem(con, tiled=True).open() as tiled:
+            self.assertEqual(dem.bounds, tiled.bounds)
+            self.assertTrue((dem.read() == tiled.read()).all())
+
+        run.get_model(con, tiled_dem=True)
+        run.model.write('tests/test_model_tiled')
+
+    def test_get_rainfall(self):
+        run = Run(100, rain_table='rain',
+                  rain_start=datetime.datetime(2000, 1, 1), rain_end=datetime.datetime(2000, 1, 3), domain_id=500)
+
+        rain, geom = run.get_rainfall(con)
+        self.assertListEqual(list(rain.index), [0, 86400, 172800])
+        self.assertListEqual(list(rain[0]), [value / 86400 / 1000 for value in [1, 2, 3]])
+        self.assertEqual(len(geom), 1)
+
+    def test_get_rainfall_grid(self):
+        cells = {(row * 4 + col + 1) * 10: box(100 + col * 250, row * 250, 350 + col * 250, 250 + row * 250)
+                 for row in range(2) for col in range(4)}
+        with con:
+            with con.cursor() as cur:
+                cur.execute("""
+                DROP TABLE IF EXISTS rain_grid;
+                CREATE TABLE rain_grid (gid serial PRIMARY KEY, geom geometry, series numeric[]);
+                DELETE FROM metadata WHERE dataset = 'rain_grid';
+                INSERT INTO metadata (dataset, frequency, start) VALUES ('rain_grid', '1 day', '2000-01-01');
+                """)
+                # Cells are inserted out of order so that misordered columns or geometries are detected
+                for base in sorted(cells, reverse=True):
+                    cur.execute("""
+                    INSERT INTO rain_grid (geom, series) VALUES (ST_GeomFromText(%(geom)s, 27700), %(series)s)
+                    """, dict(geom=cells[base].wkt, series=[base + step for step in range(1, 6)]))
+
+        run = Run(100, rain_table='rain_grid', rain_start=datetime.datetime(2000, 1, 2),
+                  rain_end=datetime.datetime(2000, 1, 4), domain_id=500)
+        rain, geom = run.get_rainfall(con)
+        expected, expected_geom = _explode_rainfall(run, datetime.datetime(2000, 1, 1), datetime.timedelta(days=1))
+
+        self.assertGreater(len(geom), 1)
+        pd.testing.assert_frame_equal(rain, expected, check_names=False)
+        self.assertTrue(geom.geom_equals(expected_geom).all())
+        self.assertEqual(geom.crs, expected_geom.crs)
+        for column in rain.columns:
+            base = round(rain[column].iloc[0] * 86400 * 1000) - 2
+            self.assertTrue(geom[column].equals(cells[base]))
+
     def test_get_model(self):
         run = Run(100, rain_table='rain',
                   rain_start=datetime.datetime(2000, 1, 1), rain_end=datetime.datetime(2000, 1, 2), domain_id=500,
@@ -40,8 +146,117 @@ class TestRun(TestCase):
         run.get_model(con)
         run.model.write('tests/test_model')
 
+    def test_get_features(self):
+        run = Run(100, rain_total=100, rain_duration=100, domain_id=500, buildings_table='buildings',
+                  green_areas_table='green_areas')
+        domain = run.get_domain(con).geom[0]
+        buildings = run.get_buildings(con)
+
+        for clip, simplify in [(True, False), (True, True), (False, True)]:
+            features = run.get_buildings(con, clip=clip, simplify=simplify)
+            self.assertEqual(features.crs, buildings.crs)
+            self.assertEqual(len(features), len(buildings))
+            self.assertTrue(features.geom.within(domain.buffer(1)).all())
+        self.assertAlmostEqual(run.get_green_areas(con, clip=True).area.sum(), run.get_green_areas(con).area.sum())
+
+        run.get_model(con, clip_features=True, simplify_features=True)
+        run.model.write('tests/test_model_clipped')
+
+    def test_get_model_lazy(self):
+        run = Run(100, rain_total=100, rain_duration=100, domain_id=500, buildings_table='buildings')
+        run.get_model(con, lazy=True)
+        self.assertIsNone(run.model)
+        self.assertNotIn('get_dem', [phase['phase'] for phase in run.metrics.phases])
+
+        run.write('tests/test_model_lazy', release=True)
+        self.assertIsNone(run.model)
+        self.assertEqual(run.srid, 27700)
+        self.assertIn('get_dem', [phase['phase'] for phase in run.metrics.phases])
+
+    def test_get_model_pool(self):
+        run = Run(100, rain_table='rain',
+                  rain_start=datetime.datetime(2000, 1, 1), rain_end=datetime.datetime(2000, 1, 2), domain_id=500,
+                  buildings_table='buildings', green_areas_table='green_areas')
+
+        run.get_model(None, pool=dsn)
+        run.model.write('tests/test_model_pool')
+
     def test_execute(self):
         run = Run(run_duration=120, rain_total=100, rain_duration=100, run_name='test',
                   output_frequency=60, domain_id=500)
         run.get_model(con)
         run.execute('tests/test_model_execute', 'tests/test_model_execute')
+
+    @mock.patch.dict(os.environ, {'CITYCAT': os.path.abspath('tests/stub_citycat.py'), 'STUB_CITYCAT_DURATION': '1'})
+    def test_execute_async(self):
+        runs = [Run(run_duration=120, rain_total=100, rain_duration=100, run_name='test',
+                    output_frequency=60, domain_id=500) for _ in range(3)]
+        for run in runs:
+            run.get_model(con)
+
+        progress = []
+        results = asyncio.run(execute_many(runs, 'tests/test_model_async', 'tests/test_model_async', concurrency=2,
+                                           progress=lambda r, fraction: progress.append(fraction)))
+        self.assertListEqual(results, [None] * 3)
+        self.assertIn(1, progress)
+        for run in runs:
+            self.assertTrue(os.path.exists(f'tests/test_model_async/{run.run_name}-{run.run_id}.nc'))
+
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(runs[0].execute_async('tests/test_model_async', 'tests/test_model_async', timeout=0.1))
+
+    @mock.patch.dict(os.environ, {'CITYCAT': os.path.abspath('tests/stub_citycat.py'), 'STUB_CITYCAT_DURATION': '1'})
+    def test_execute_stream(self):
+        run = Run(run_duration=120, rain_total=100, rain_duration=100, run_name='test',
+                  output_frequency=60, domain_id=500)
+        run.get_model(con)
+        run.execute('tests/test_model_stream', 'tests/test_model_stream', stream=True, delete=True)
+
+        self.assertTrue(os.path.exists(f'tests/test_model_stream/{run.run_name}-{run.run_id}.nc'))
+        self.assertTrue(os.path.exists(f'tests/test_model_stream/{run.run_name}-{run.run_id}.tif'))
+        self.assertListEqual(
+            os.listdir(f'tests/test_model_stream/{run.run_name}-{run.run_id}/R1C1_SurfaceMaps'),
+            ['R1_C1_max_depth.csv'])
+
+    @mock.patch.dict(os.environ, {'CITYCAT': os.path.abspath('tests/stub_citycat.py')})
+    def test_write_store(self):
+        store = InputStore('tests/test_store')
+        model_paths = []
+        for rain_total in [100, 200]:
+            run = Run(run_duration=120, rain_total=rain_total, rain_duration=100, run_name='test',
+                      output_frequency=60, domain_id=500, buildings_table='buildings')
+            run.get_model(con)
+            model_paths.append(run.write('tests/test_model_store', store))
+
+        for file_name in ['Domain_DEM.ASC', 'Buildings.txt', 'BCs_open.txt', 'stub_citycat.py']:
+            self.assertTrue(os.path.samefile(*[os.path.join(model_path, file_name) for model_path in model_paths]))
+
+    @mock.patch.dict(os.environ, {'CITYCAT': os.path.abspath('tests/stub_citycat.py'), 'STUB_CITYCAT_DURATION': '0'})
+    def test_save_metrics(self):
+        run = Run(run_duration=120, rain_total=100, rain_duration=100, run_name='test',
+                  output_frequency=60, domain_id=500, buildings_table='buildings')
+        run.add(con)
+        run.get_model(con)
+        asyncio.run(run.execute_async('tests/test_model_metrics', 'tests/test_model_metrics'))
+
+        totals = run.metrics.totals()
+        for phase in ['get_dem', 'get_rainfall', 'get_domain', 'get_buildings', 'write', 'solver', 'netcdf',
+                      'geotiff']:
+            self.assertEqual(totals[phase]['count'], 1)
+        self.assertGreater(totals['write']['bytes'], 0)
+        self.assertIn('citycatpg_phase_seconds_total{phase="solver"}', run.metrics.to_text())
+
+        with con:
+            with con.cursor() as cur:
+                cur.execute('DROP TABLE IF EXISTS run_metrics')
+        run.save_metrics(con)
+        with con.cursor() as cur:
+            cur.execute('SELECT count(*) FROM run_metrics WHERE run_id = %s', (run.run_id,))
+            self.assertEqual(cur.fetchone()[0], len(run.metrics.phases))
+        self.assertIsNotNone(fetch(con, run.run_id).run_end)
+
+        server_metrics = Metrics(keep_phases=False)
+        server_metrics.extend(run.metrics.phases)
+        server_metrics.extend(run.metrics.phases)
+        self.assertListEqual(server_metrics.phases, [])
+        self.assertEqual(server_metrics.totals()['solver']['count'], 2)
@@ -0,0 +1,36 @@
+from citycatpg import Run, Metrics, add_many, pgqueue, scheduling
+from unittest import TestCase
+from .setup_tests import con
+import datetime
+
+
+class TestScheduling(TestCase):
+
+    def setUp(self):
+        with con:
+            with con.cursor() as cur:
+                cur.execute('DROP TABLE IF EXISTS runs; DROP TABLE IF EXISTS run_metrics')
+        self.runs = [Run(run_duration=duration, rain_total=100, rain_duration=120, run_name='test',
+                         output_frequency=60, domain_id=500) for duration in [600, 3600, 1200]]
+        add_many(con, self.runs)
+
+    def test_longest_first(self):
+        ordered = scheduling.longest_first(con, self.runs)
+        self.assertListEqual([run.run_duration for run in ordered], [3600, 1200, 600])
+
+    def test_fit(self):
+        for run in self.runs:
+            metrics = Metrics()
+            metrics.extend([dict(phase='solver', start=datetime.datetime.now(), seconds=run.run_duration / 10,
+                                 rows=None, bytes=None)])
+            metrics.save(con, run.run_id)
+
+        cost_model = scheduling.CostModel().fit(con)
+        for run, cost in zip(self.runs, cost_model.estimate(con, self.runs)):
+            self.assertAlmostEqual(cost, run.run_duration / 10, places=3)
+
+    def test_enqueue(self):
+        pgqueue.create_queue(con)
+        scheduling.enqueue(con, self.runs)
+        claimed = pgqueue.claim(con, 'a', batch_size=1) + pgqueue.claim(con, 'a', batch_size=1)
+        self.assertListEqual([run.run_duration for run in claimed], [3600, 1200])
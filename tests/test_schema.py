@@ -0,0 +1,23 @@
+from citycatpg import Run, schema
+from unittest import TestCase
+from .setup_tests import con
+
+
+class TestSchema(TestCase):
+
+    def test_optimise(self):
+        run = Run(100, rain_table='rain', domain_id=500, buildings_table='buildings', green_areas_table='green_areas')
+        report = schema.optimise(con, run)
+        self.assertSetEqual(set(report['costs']), {'dem', 'domain', 'rain', 'buildings', 'green_areas', 'metadata'})
+
+        report = schema.optimise(con, run)
+        self.assertListEqual(report['indexes'], [])
+        self.assertFalse(report['constraints'])
+
+        # Aligned tiles outside the current extent can still be added
+        with con.cursor() as cur:
+            cur.execute("""
+            INSERT INTO dem (rast)
+            SELECT ST_SetUpperLeft(rast, ST_UpperLeftX(rast) + 100000, ST_UpperLeftY(rast)) FROM dem LIMIT 1
+            """)
+        con.rollback()
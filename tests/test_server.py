@@ -3,7 +3,8 @@ from citycatpg.run import Run
 from unittest import TestCase
 import pika
 import os
-from .setup_tests import con
+import uuid
+from .setup_tests import con, dsn
 
 
 class TestServer(TestCase):
@@ -34,3 +35,64 @@ class TestServer(TestCase):
         # Note: sending a short heartbeat to prove that heartbeats are still sent
         server.run_server(queue=queue, con=con, run_path=os.path.abspath('tests/test_model_from_queue'),
                           out_path=os.path.abspath('tests/test_model_from_queue'), close=True, heartbeat=1)
+
+    def test_run_server_workers(self):
+        queue = 'test_workers'
+        connection = pika.BlockingConnection(pika.ConnectionParameters('localhost', port=5672))
+        channel = connection.channel()
+        channel.queue_delete(queue=queue)
+        channel.queue_declare(queue=queue, durable=True)
+
+        for _ in range(3):
+            run = Run(run_duration=120, rain_total=100, rain_duration=120, run_name='test',
+                      output_frequency=60, domain_id=500)
+            run.add(con)
+
+            channel.basic_publish(exchange='',
+                                  routing_key=queue,
+                                  body=run.run_id,
+                                  properties=pika.BasicProperties(delivery_mode=2)
+                                  )
+
+        server.run_server(None, queue=queue, run_path=os.path.abspath('tests/test_model_from_workers'),
+                          out_path=os.path.abspath('tests/test_model_from_workers'), close=True, workers=2, dsn=dsn)
+        self.assertEqual(channel.queue_declare(queue=queue, durable=True).method.message_count, 0)
+
+    def test_run_server_stage_ahead(self):
+        queue = 'test_stage_ahead'
+        connection = pika.BlockingConnection(pika.ConnectionParameters('localhost', port=5672))
+        channel = connection.channel()
+        channel.queue_delete(queue=queue)
+        channel.queue_declare(queue=queue, durable=True)
+
+        for _ in range(3):
+            run = Run(run_duration=120, rain_total=100, rain_duration=120, run_name='test',
+                      output_frequency=60, domain_id=500)
+            run.add(con)
+
+            channel.basic_publish(exchange='',
+                                  routing_key=queue,
+                                  body=run.run_id,
+                                  properties=pika.BasicProperties(delivery_mode=2)
+                                  )
+
+        server.run_server(None, queue=queue, run_path=os.path.abspath('tests/test_model_staged'),
+                          out_path=os.path.abspath('tests/test_model_staged'), close=True, stage_ahead=2, dsn=dsn)
+        self.assertEqual(channel.queue_declare(queue=queue, durable=True).method.message_count, 0)
+
+    def test_run_server_failure(self):
+        queue = 'test_failure'
+        connection = pika.BlockingConnection(pika.ConnectionParameters('localhost', port=5672))
+        channel = connection.channel()
+        channel.queue_delete(queue=queue)
+        channel.queue_declare(queue=queue, durable=True)
+
+        channel.basic_publish(exchange='',
+                              routing_key=queue,
+                              body=str(uuid.uuid4()),
+                              properties=pika.BasicProperties(delivery_mode=2)
+                              )
+
+        server.run_server(queue=queue, con=con, run_path=os.path.abspath('tests/test_model_failure'),
+                          out_path=os.path.abspath('tests/test_model_failure'), close=True, retries=1)
+        self.assertEqual(channel.queue_declare(queue=queue, durable=True).method.message_count, 0)
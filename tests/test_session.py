@@ -0,0 +1,46 @@
+from citycatpg import Run, Session, fetch, fetch_many
+from unittest import TestCase
+from concurrent.futures import ThreadPoolExecutor
+from .setup_tests import con, dsn
+import datetime
+
+
+class TestSession(TestCase):
+
+    def test_fetch(self):
+        run = Run(rain_table='rain', run_duration=500, domain_id=500, buildings_table='buildings',
+                  green_areas_table='green_areas', rain_start=datetime.datetime(2000, 1, 1),
+                  rain_end=datetime.datetime(2000, 1, 2))
+        run.add(con)
+
+        session = Session(dsn, maxconn=2)
+        try:
+            for _ in range(3):
+                fetched = fetch(session, run.run_id)
+                fetched.get_model(session)
+            self.assertEqual(fetched.run_id, run.run_id)
+            self.assertEqual(len(session._idle), 2)
+            self.assertListEqual([r.run_id for r in fetch_many(session, [run.run_id])], [run.run_id])
+
+            with session.connection() as session_con:
+                with session_con.cursor() as cur:
+                    cur.execute("SELECT count(*) FROM pg_prepared_statements WHERE name LIKE 'citycatpg_%'")
+                    self.assertGreater(cur.fetchone()[0], 0)
+        finally:
+            session.close()
+
+    def test_checkout(self):
+        session = Session(dsn, maxconn=2)
+
+        def query(value):
+            with session.connection() as session_con:
+                with session_con.cursor() as cur:
+                    cur.execute('SELECT %(value)s', dict(value=value))
+                    return cur.fetchone()[0]
+
+        try:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                self.assertListEqual(list(executor.map(query, range(20))), list(range(20)))
+            self.assertLessEqual(len(session._idle), 2)
+        finally:
+            session.close()
@@ -0,0 +1,53 @@
+from citycatpg import Run, Sweep, DomainCache, fetch
+from unittest import TestCase
+from .setup_tests import con
+import datetime
+import pika
+
+
+class TestSweep(TestCase):
+
+    def test_get_models(self):
+        base = Run(100, rain_table='rain', rain_start=datetime.datetime(2000, 1, 1), domain_id=500,
+                   buildings_table='buildings', green_areas_table='green_areas')
+        sweep = Sweep(base, rain_start=[datetime.datetime(2000, 1, 1), datetime.datetime(2000, 1, 2)],
+                      rain_end=[datetime.datetime(2000, 1, 3), datetime.datetime(2000, 1, 4)])
+        self.assertEqual(len(sweep), 4)
+
+        cache = DomainCache()
+        for member in sweep.get_models(con, cache=cache):
+            rain, _ = member.get_rainfall(con)
+            self.assertTrue(member.model.rainfall.data.equals(rain))
+            self.assertEqual(member.metrics.totals().get('get_dem', {}).get('count'), 1)
+
+        self.assertEqual(len(cache._items), 4)
+
+    def test_get_models_lazy(self):
+        base = Run(100, rain_total=100, rain_duration=100, run_name='lazy', domain_id=500, buildings_table='buildings')
+        sweep = Sweep(base, friction=[0.02, 0.03, 0.04])
+
+        cache = DomainCache()
+        for member in sweep.get_models(con, cache=cache, lazy=True):
+            self.assertIsNone(member.model)
+            member.write('tests/test_sweep_lazy', release=True)
+            self.assertIsNone(member.model)
+            self.assertEqual(member.metrics.totals()['get_dem']['count'], 1)
+
+        self.assertEqual(len(cache._items), 3)
+
+    def test_add(self):
+        base = Run(run_duration=120, rain_total=100, rain_duration=120, run_name='sweep', domain_id=500)
+        sweep = Sweep(base, rain_total=[50, 100], friction=[0.02, 0.03, 0.04])
+        sweep.get_models(con, open_boundaries=False)
+
+        run_ids = sweep.add(con)
+        self.assertEqual(len(set(run_ids)), 6)
+        self.assertEqual(fetch(con, run_ids[-1]).friction, 0.04)
+
+        queue = 'test_sweep'
+        connection = pika.BlockingConnection(pika.ConnectionParameters('localhost', port=5672))
+        channel = connection.channel()
+        channel.queue_delete(queue=queue)
+        sweep.publish(queue)
+        self.assertEqual(channel.queue_declare(queue=queue, durable=True).method.message_count, 6)
+        connection.close()
@@ -0,0 +1,45 @@
+from citycatpg import Run, tiles
+from unittest import TestCase
+from rasterio.transform import from_origin
+from .setup_tests import con
+import numpy as np
+import rasterio as rio
+import os
+
+
+class TestTiles(TestCase):
+
+    def test_split_domain(self):
+        run = Run(run_duration=120, rain_total=100, rain_duration=120, run_name='test', domain_id=500,
+                  buildings_table='buildings')
+        children = tiles.split_domain(con, run, tile_size=300, overlap=50)
+        self.assertEqual(len(children), 6)
+
+        cores = tiles.get_cores(con, children)
+        self.assertEqual(min(core[0] for core in cores.values()), 100)
+        self.assertEqual(max(core[3] for core in cores.values()), 500)
+
+        for child in children:
+            child.get_model(con)
+            left, bottom, right, top = cores[child.run_id]
+            with child.model.dem.data.open() as dem:
+                self.assertLessEqual(dem.bounds.top, top + 50)
+                self.assertGreaterEqual(dem.bounds.left, left - 50)
+
+        self.assertEqual(len(tiles.split_domain(con, run, tile_size=1000, overlap=0)), 1)
+
+    def test_mosaic_geotiff(self):
+        os.makedirs('tests/test_tiles', exist_ok=True)
+        cores = {}
+        for col, left in enumerate([0, 80]):
+            path = f'tests/test_tiles/{col}.tif'
+            with rio.open(path, 'w', driver='GTiff', width=24, height=20, count=1, dtype='float64', nodata=-999,
+                          transform=from_origin(left, 100, 5, 5)) as dst:
+                dst.write(np.full((20, 24), col, dtype='float64'), 1)
+            cores[path] = (col * 100, 0, col * 100 + 100, 100)
+
+        tiles.mosaic_geotiff(cores, 'tests/test_tiles/mosaic.tif')
+        with rio.open('tests/test_tiles/mosaic.tif') as src:
+            array = src.read(1)
+        self.assertEqual(array.shape, (20, 40))
+        self.assertTrue((array[:, :20] == 0).all() and (array[:, 20:] == 1).all())